@@ -0,0 +1,121 @@
+"""
+Throughput of gpt_utils_async + async_robust_task against the local fake
+OpenAI server (squidtools.fake_openai), so concurrency settings can be
+tuned and regressions caught without an API key or network.
+
+    python benchmarks/bench_gpt.py --items 500 --concurrency 25,100 --rate-429 0.02
+
+For each runner mode and concurrency prints items/sec, p50/p99 item
+latency, failed items and the retries the server saw (requests beyond
+one per item, by cause).
+"""
+import os
+import sys
+import argparse
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from squidtools import gpt_utils_async
+from squidtools.fake_openai import FakeOpenAIServer
+from squidtools.gpt_accounting import RunAccounting
+from squidtools.metrics import RunMetrics
+from squidtools.rate_limit import AdaptiveLimiter
+from squidtools.robust_task import async_robust_task
+
+MODES = ("batch", "window", "adaptive")
+
+
+async def task(input):
+    result, cost = await gpt_utils_async.json_prompt("Answer in JSON:", input)
+    return result
+
+
+def runner_kwargs(mode, concurrency):
+    if mode == "batch":
+        return {"batch_size": concurrency}
+    if mode == "window":
+        return {"batch_size": concurrency, "sliding_window": True}
+    if mode == "adaptive":
+        return {"rate_limiter": AdaptiveLimiter(start=max(1, concurrency // 4), max_concurrency=concurrency)}
+    raise ValueError(f"unknown mode {mode}")
+
+
+def bench(server, mode, concurrency, items, timeout, workdir):
+    # Fresh client and shared state for every run
+    gpt_utils_async.set_client_factory(server.client)
+    gpt_utils_async.set_accounting(RunAccounting())
+    gpt_utils_async.cooldown_until = 0.0
+    before = server.stats()
+    metrics = RunMetrics(interval=3600)
+    progress_name = os.path.join(workdir, f"{mode}-{concurrency}.json")
+    async_robust_task(
+        [f"item {i}" for i in range(items)],
+        task,
+        progress_name=progress_name,
+        show_progress=False,
+        timeout=timeout,
+        retry_errs=False,
+        metrics=metrics,
+        **runner_kwargs(mode, concurrency),
+    )
+    after = server.stats()
+    seen = {k: after.get(k, 0) - before.get(k, 0) for k in after}
+    snapshot = metrics.snapshot()
+    return {
+        "mode": mode,
+        "concurrency": concurrency,
+        "items_per_sec": snapshot["items_per_sec"],
+        "p50": snapshot["latency"]["p50"],
+        "p99": snapshot["latency"]["p99"],
+        "failed": snapshot["failed"],
+        "retries": seen.get("requests", 0) - items,
+        "429": seen.get("429", 0),
+        "5xx": seen.get("500", 0) + seen.get("502", 0),
+        "malformed": seen.get("malformed", 0),
+    }
+
+
+def print_table(rows):
+    columns = list(rows[0])
+    print("\t".join(columns))
+    for row in rows:
+        print("\t".join(f"{v:.3f}" if isinstance(v, float) else str(v) for v in row.values()))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--items", type=int, default=300)
+    parser.add_argument("--modes", default=",".join(MODES))
+    parser.add_argument("--concurrency", default="10,50")
+    parser.add_argument("--timeout", type=float, default=30)
+    parser.add_argument("--latency-median", type=float, default=0.2)
+    parser.add_argument("--latency-sigma", type=float, default=0.5)
+    parser.add_argument("--rate-429", type=float, default=0.0)
+    parser.add_argument("--rate-500", type=float, default=0.0)
+    parser.add_argument("--rate-502", type=float, default=0.0)
+    parser.add_argument("--rate-malformed", type=float, default=0.0)
+    parser.add_argument("--retry-after", type=float, default=0.5)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    server = FakeOpenAIServer(
+        latency_median=args.latency_median,
+        latency_sigma=args.latency_sigma,
+        rate_429=args.rate_429,
+        rate_500=args.rate_500,
+        rate_502=args.rate_502,
+        rate_malformed=args.rate_malformed,
+        retry_after=args.retry_after,
+        seed=args.seed,
+    )
+    rows = []
+    with server, tempfile.TemporaryDirectory() as workdir:
+        for mode in args.modes.split(","):
+            for concurrency in (int(c) for c in args.concurrency.split(",")):
+                rows.append(bench(server, mode, concurrency, args.items, args.timeout, workdir))
+    print_table(rows)
+
+
+if __name__ == "__main__":
+    main()
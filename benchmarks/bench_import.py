@@ -0,0 +1,85 @@
+"""
+Import time of each squidtools submodule, each in a fresh interpreter, checked
+against a budget so heavy imports (spaCy models, openai, credentials) don't
+creep back into module import.
+
+    python benchmarks/bench_import.py --budget 0.3
+
+Exits with status 1 if any module goes over its budget. Modules whose
+third-party dependencies aren't installed are reported and skipped.
+"""
+import os
+import sys
+import json
+import argparse
+import subprocess
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+
+MODULES = [
+    "export", "failures", "fake_openai", "gpt_accounting", "gpt_batch", "gpt_cache", "gpt_limits",
+    "gpt_utils", "gpt_utils_async", "json_stream", "linkedin", "metrics", "muckrack", "names",
+    "progress_store", "proquest", "qualtrics", "rate_limit", "robust_task", "sharding", "util",
+    "webscraper", "workflow",
+]
+# Modules that import big third-party libraries they really need up front
+BUDGET_OVERRIDES = {"linkedin": 2.0, "muckrack": 2.0, "webscraper": 2.0}
+
+MEASURE = """
+import json, sys, time
+started = time.perf_counter()
+try:
+    import squidtools.{module}
+except ImportError as e:
+    print(json.dumps({{"missing": str(e)}}))
+    sys.exit(0)
+print(json.dumps({{"seconds": time.perf_counter() - started}}))
+"""
+
+
+def measure(module, repeat):
+    # Best of a few runs, in a fresh interpreter every time
+    env = {k: v for k, v in os.environ.items() if k not in ("OPENAI_KEY", "QUALTRICS_TOKEN", "QUALTRICS_DC")}
+    env["PYTHONPATH"] = ROOT + os.pathsep + env.get("PYTHONPATH", "")
+    best = None
+    for _ in range(repeat):
+        out = subprocess.run(
+            [sys.executable, "-c", MEASURE.format(module=module)], capture_output=True, text=True, env=env
+        )
+        if out.returncode != 0:
+            return {"error": out.stderr.strip().splitlines()[-1]}
+        result = json.loads(out.stdout.strip().splitlines()[-1])
+        if "missing" in result:
+            return result
+        best = result["seconds"] if best is None else min(best, result["seconds"])
+    return {"seconds": best}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--budget", type=float, default=0.3, help="seconds allowed per module import")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("modules", nargs="*", default=MODULES)
+    args = parser.parse_args()
+
+    over = []
+    for module in args.modules:
+        budget = BUDGET_OVERRIDES.get(module, args.budget)
+        result = measure(module, args.repeat)
+        if "seconds" in result:
+            ok = result["seconds"] <= budget
+            if not ok:
+                over.append(module)
+            print(f"{module}\t{result['seconds']:.3f}s\t(budget {budget}s)\t{'ok' if ok else 'OVER BUDGET'}")
+        elif "missing" in result:
+            print(f"{module}\tskipped, {result['missing']}")
+        else:
+            over.append(module)
+            print(f"{module}\tfailed to import: {result['error']}")
+    if over:
+        print(f"{len(over)} modules over budget or failing: {', '.join(over)}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
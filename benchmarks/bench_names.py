@@ -0,0 +1,179 @@
+"""
+Micro-benchmark for names normalization and matching: the cached
+clean / parseName / simpleMatchScore against the original uncached versions
+(copied below as the baseline), over a synthetic byline corpus where, as in
+ProQuest, a few thousand distinct names make up most of the bylines.
+
+    python benchmarks/bench_names.py --bylines 50000 --pairs 200000
+
+Checks that both versions give identical results before timing them.
+"""
+import os
+import sys
+import time
+import random
+import string
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from squidtools import names
+
+FIRSTS = ["John", "Mary", "James", "Patricia", "Robert", "Jennifer", "Michael", "Linda", "Wei", "Maria",
+          "Jose", "Fatima", "David", "Elizabeth", "Sylvan", "Aisha", "Thomas", "Susan", "Kenji", "Olga"]
+LASTS = ["Smith", "Johnson", "Williams", "Brown", "Jones", "Garcia", "Miller", "Davis", "Rodriguez", "Martinez",
+         "Zheng", "Nguyen", "O'Brien", "Walker", "Kim", "Patel", "de la Cruz", "Van Dyke", "Lee", "Cohen"]
+
+
+def byline_corpus(n, distinct, seed=0):
+    rng = random.Random(seed)
+    people = []
+    for _ in range(distinct):
+        first, last = rng.choice(FIRSTS), rng.choice(LASTS)
+        style = rng.random()
+        if style < 0.3:
+            people.append(f"{last}, {first}")
+        elif style < 0.5:
+            people.append(f"{first} {rng.choice(string.ascii_uppercase)}. {last}")
+        elif style < 0.55:
+            people.append(f"{first} {last} Jr.")
+        elif style < 0.6:
+            people.append(f"{first.upper()} {last.upper()}")
+        else:
+            people.append(f"{first} {last}")
+    # A few prolific reporters write most of the articles
+    weights = [1 / (i + 1) for i in range(distinct)]
+    return rng.choices(people, weights=weights, k=n)
+
+
+# Baseline: the implementation before caching
+
+def clean(name, remove_punct=True):
+    n = name.lower().strip()
+    if remove_punct:
+        return n.translate(str.maketrans('', '', string.punctuation)).strip()
+    else:
+        return n
+
+def isSuffix(suffix):
+    SUFFIXES = ["jr", "sr", "i", "ii", "iii", "iv", "v"]
+    return clean(suffix) in SUFFIXES
+
+def isInitial(init):
+    return len(clean(init)) == 1
+
+def parseNormalizedName(namestr):
+    suffix = None
+    middleInitial = None
+    components = namestr.split(',')
+    lastname = components[0]
+    f_comps = components[1].strip().split(' ')
+    if len(f_comps) == 1:
+        firstname = f_comps[0]
+    elif len(f_comps) == 2 and isInitial(f_comps[1]):
+        firstname = f_comps[0]
+        middleInitial = f_comps[1]
+    elif len(f_comps) == 2 and isSuffix(f_comps[1]):
+        firstname = f_comps[0]
+        suffix = f_comps[1]
+    elif len(f_comps) == 2:
+        firstname = f_comps[0]
+        middleInitial = f_comps[1][0]
+    else:
+        return None
+    return {'firstname': firstname, 'middleInitial': middleInitial, 'lastname': lastname, 'suffix': suffix}
+
+def parseRawName(namestr):
+    firstname = None
+    middleInitial = None
+    lastname = None
+    suffix = None
+    components = clean(namestr).split(' ')
+    if isSuffix(components[-1]):
+        suffix = components[-1]
+        components.remove(components[-1])
+    if len(components) == 2 and not isInitial(components[1]):
+        firstname = components[0]
+        lastname = components[1]
+    elif len(components) == 3 and isInitial(components[1]):
+        firstname = components[0]
+        middleInitial = components[1]
+        lastname = components[2]
+    else:
+        return None
+    return {'firstname': firstname, 'middleInitial': middleInitial, 'lastname': lastname, 'suffix': suffix}
+
+def parseName(name):
+    if names.isNormalizedName(name):
+        return parseNormalizedName(name)
+    else:
+        return parseRawName(name)
+
+def parseAndCompareNames(name1, name2):
+    no1 = parseName(name1)
+    no2 = parseName(name2)
+    if no1 is None or no2 is None:
+        return None
+
+    def cmp_part(no1, no2, part):
+        if no1[part] is None or no2[part] is None:
+            return 0.2
+        return 1 if clean(no1[part]) == clean(no2[part]) else 0
+
+    return {
+        'firstname': cmp_part(no1, no2, 'firstname'),
+        'middleInitial': cmp_part(no1, no2, 'middleInitial'),
+        'lastname': cmp_part(no1, no2, 'lastname'),
+    }
+
+def simpleMatchScore(name1, name2):
+    if name1 == name2:
+        return 1.0
+    if clean(name1) == clean(name2):
+        return 0.99
+    pieces1 = set(clean(name1).split(" "))
+    pieces2 = set(clean(name2).split(" "))
+    common = pieces1.intersection(pieces2)
+    if len(common) == len(pieces1) and len(common) == len(pieces2):
+        return 0.95
+    pcresult = parseAndCompareNames(name1, name2)
+    if pcresult:
+        return pcresult['lastname'] * 0.5 + pcresult['firstname'] * 0.3 + pcresult['middleInitial'] * 0.1
+    return len(common) / ((max(len(pieces1), len(pieces2))) + 0.1)
+
+
+def timed(f, *args):
+    started = time.perf_counter()
+    result = f(*args)
+    return result, time.perf_counter() - started
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--bylines", type=int, default=50000)
+    parser.add_argument("--distinct", type=int, default=3000)
+    parser.add_argument("--pairs", type=int, default=200000)
+    args = parser.parse_args()
+
+    corpus = byline_corpus(args.bylines, args.distinct)
+    rng = random.Random(1)
+    pairs = [(rng.choice(corpus), rng.choice(corpus)) for _ in range(args.pairs)]
+
+    benchmarks = [
+        ("clean", lambda f: [f(b) for b in corpus], clean, names.clean),
+        ("parseName", lambda f: [f(b) for b in corpus], parseName, names.parseName),
+        ("simpleMatchScore", lambda f: [f(a, b) for a, b in pairs], simpleMatchScore, names.simpleMatchScore),
+    ]
+    print("function\tbaseline s\tcached s\tspeedup")
+    for label, run, baseline, cached in benchmarks:
+        expected, baseline_time = timed(run, baseline)
+        names.clean.cache_clear()
+        names.parseNameCached.cache_clear()
+        names.namePieces.cache_clear()
+        got, cached_time = timed(run, cached)
+        assert got == expected, f"{label} results differ"
+        print(f"{label}\t{baseline_time:.3f}\t{cached_time:.3f}\t{baseline_time / cached_time:.1f}x")
+
+
+if __name__ == "__main__":
+    main()
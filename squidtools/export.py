@@ -0,0 +1,116 @@
+import os
+import json
+
+from .progress_store import open_progress
+from .util import gen_batches
+
+"""
+Columnar export of robust_task progress.
+
+progress_to_arrow streams a progress store into a Parquet or Arrow IPC
+(Feather v2) file chunk by chunk, so result sets larger than memory can be
+loaded straight into pandas / DuckDB / polars:
+
+    progress_to_arrow("progress.json", "results.parquet")
+    pd.read_parquet("results.parquet")
+
+The schema is the union of every record's fields, inferred in a first pass
+over the store. Nested dicts and lists are kept as struct and list columns.
+Fields whose values can't be given one type (eg a number in some records and
+a string in others) are written as JSON strings.
+
+Requires pyarrow (pip install pyarrow).
+"""
+
+ARROW_EXTENSIONS = (".arrow", ".feather", ".ipc")
+
+
+def _import_pyarrow():
+    try:
+        import pyarrow
+    except ImportError as e:
+        raise ImportError("progress_to_arrow requires pyarrow, pip install pyarrow") from e
+    return pyarrow
+
+
+def _unify(pa, a, b):
+    if a == b:
+        return a
+    try:
+        schema = pa.unify_schemas(
+            [pa.schema([pa.field("f", a)]), pa.schema([pa.field("f", b)])],
+            promote_options="permissive",
+        )
+        return schema.field("f").type
+    except (pa.ArrowInvalid, pa.ArrowTypeError, pa.ArrowNotImplementedError):
+        return None
+
+
+def infer_schema(records, chunk_size=10000):
+    """
+    Union schema over (key, record) pairs, returns the schema and the
+    names of the fields that have to be stored as JSON strings
+    """
+    pa = _import_pyarrow()
+    types = {}
+    json_fields = set()
+    for chunk in gen_batches(records, chunk_size):
+        names = {}
+        for _, record in chunk:
+            names.update(dict.fromkeys(record))
+        for name in names:
+            if name in json_fields:
+                continue
+            try:
+                t = pa.array([record.get(name) for _, record in chunk]).type
+            except (pa.ArrowInvalid, pa.ArrowTypeError):
+                t = None
+            if t is not None and name in types:
+                t = _unify(pa, types[name], t)
+            if t is None:
+                json_fields.add(name)
+                types[name] = pa.string()
+            else:
+                types[name] = t
+    return pa.schema([pa.field(name, t) for name, t in types.items()]), json_fields
+
+
+def _to_table(pa, chunk, schema, json_fields):
+    columns = []
+    for field in schema:
+        values = [record.get(field.name) for _, record in chunk]
+        if field.name in json_fields:
+            values = [None if v is None else json.dumps(v) for v in values]
+        columns.append(pa.array(values, type=field.type))
+    return pa.Table.from_arrays(columns, schema=schema)
+
+
+def progress_to_arrow(progress, out, format=None, chunk_size=10000, compression="zstd"):
+    """
+    progress: a progress store or a progress filename
+    out: output filename, format is taken from the extension if not given
+    format: "parquet" or "arrow" (Arrow IPC / Feather v2)
+    Returns the number of records written
+    """
+    pa = _import_pyarrow()
+    if isinstance(progress, str):
+        progress = open_progress(progress, readonly=True)
+    if format is None:
+        format = "arrow" if os.path.splitext(out)[1] in ARROW_EXTENSIONS else "parquet"
+
+    schema, json_fields = infer_schema(progress.records(), chunk_size)
+    if format == "parquet":
+        import pyarrow.parquet as pq
+
+        writer = pq.ParquetWriter(out, schema, compression=compression)
+    elif format == "arrow":
+        writer = pa.ipc.new_file(out, schema)
+    else:
+        raise ValueError(f"unknown format {format}, use parquet or arrow")
+
+    n = 0
+    with writer:
+        for chunk in gen_batches(progress.records(), chunk_size):
+            writer.write_table(_to_table(pa, chunk, schema, json_fields))
+            n += len(chunk)
+    return n
@@ -0,0 +1,123 @@
+import os
+import json
+import time
+import random
+
+"""
+Failure ledger and retry policies for robust_task.
+
+Every item that fails is recorded in a sidecar file next to the progress file
+(progress.json.failures), one JSON line per failed attempt, with the exception
+class, the error message, the attempt count and the input itself. A later
+success appends a "resolved" line. robust_task.retry_failed re-runs whatever
+is still unresolved without going back over all the inputs.
+
+Retry policies decide whether a failed item is tried again during the run,
+and after how long:
+
+    policies = {
+        "RateLimitError": RetryPolicy(max_attempts=8, base_delay=2, max_delay=120),
+        TimeoutError: RetryPolicy(max_attempts=2, timeout_multiplier=2),
+    }
+    async_robust_task(objs, task, retry_policy=policies)
+
+Policies are looked up by exception class or class name along the exception's
+MRO, so an Exception entry acts as the default. A single RetryPolicy applies
+to every exception.
+"""
+
+LEDGER_SUFFIX = ".failures"
+
+
+class RetryPolicy:
+    """
+    max_attempts: total attempts including the first one
+    base_delay/max_delay: exponential backoff bounds in seconds
+    jitter: fraction of each delay that is randomized
+    timeout_multiplier: async_robust_task scales the timeout by this much per attempt
+    """
+
+    def __init__(self, max_attempts=3, base_delay=1, max_delay=60, jitter=0.5, timeout_multiplier=1):
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.jitter = jitter
+        self.timeout_multiplier = timeout_multiplier
+
+    def delay(self, attempt):
+        """Seconds to wait before the next attempt, or None to give up"""
+        if attempt >= self.max_attempts:
+            return None
+        delay = min(self.max_delay, self.base_delay * 2 ** (attempt - 1))
+        return delay * (1 - self.jitter * random.random())
+
+
+def policy_for(policies, e):
+    if policies is None or isinstance(policies, RetryPolicy):
+        return policies
+    for cls in type(e).__mro__:
+        for key in (cls, cls.__name__):
+            if key in policies:
+                return policies[key]
+    return None
+
+
+class FailureLedger:
+    """
+    Append-only JSONL log of failed items, with the latest unresolved entry
+    for each key kept in memory (failures should be the exception).
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.failures = {}
+        if os.path.exists(path):
+            with open(path, "rt") as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        # Partial last line from a crash
+                        continue
+                    if entry.get("resolved"):
+                        self.failures.pop(entry["_pkey"], None)
+                    else:
+                        self.failures[entry["_pkey"]] = entry
+
+    def _append(self, entry):
+        with open(self.path, "at") as f:
+            f.write(json.dumps(entry) + "\n")
+
+    def record(self, key, input, e):
+        previous = self.failures.get(key)
+        entry = {
+            "_pkey": key,
+            "exception": e.__class__.__name__,
+            "error": str(e),
+            "attempts": previous["attempts"] + 1 if previous else 1,
+            "time": time.time(),
+        }
+        try:
+            json.dumps(input)
+            entry["input"] = input
+        except TypeError:
+            # Not JSON serializable, retry_failed won't be able to re-run it
+            pass
+        self.failures[key] = entry
+        self._append(entry)
+        return entry["attempts"]
+
+    def resolve(self, key):
+        if key in self.failures:
+            del self.failures[key]
+            self._append({"_pkey": key, "resolved": True, "time": time.time()})
+
+    def __contains__(self, key):
+        return key in self.failures
+
+    def __len__(self):
+        return len(self.failures)
+
+    def pending(self):
+        """Unresolved failures as a dict of key -> input"""
+        return {k: f["input"] for k, f in self.failures.items() if "input" in f}
@@ -0,0 +1,230 @@
+import json
+import time
+import random
+import argparse
+import threading
+from collections import Counter
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+"""
+Local stand-in for the OpenAI chat completions endpoint, for load testing
+gpt_utils_async / async_robust_task without spending money.
+
+Replies arrive after a lognormal latency, and a configurable share of
+requests get a 429 (with retry-after-ms), 500 or 502, or a reply that
+isn't valid JSON. Streaming requests get SSE chunks like the real API.
+
+    with FakeOpenAIServer(latency_median=0.3, rate_429=0.05) as server:
+        gpt_utils_async.set_client_factory(server.client)
+        ...
+        server.stats()
+
+or run it on its own and point the client at it:
+
+    python -m squidtools.fake_openai --port 8000 --rate-500 0.02
+    OPENAI_BASE_URL=http://127.0.0.1:8000/v1 OPENAI_KEY=fake python job.py
+"""
+
+MODEL_NAMES = {"gpt-3.5-turbo": "gpt-3.5-turbo-0125", "gpt-4": "gpt-4-0613", "gpt-4o": "gpt-4o-2024-08-06"}
+MALFORMED_REPLY = "Sure! Here is the JSON you asked for: {\"answer\": "
+
+
+def default_reply(messages):
+    return json.dumps({"answer": messages[-1]["content"][-40:], "ok": True})
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send(self, status, body, headers=()):
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        for name, value in headers:
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _error(self, status, message, kind, headers=()):
+        self._send(status, {"error": {"message": message, "type": kind, "code": None, "param": None}}, headers)
+
+    def do_POST(self):
+        fake = self.server.fake
+        request = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+        if not self.path.rstrip("/").endswith("/chat/completions"):
+            fake.count("404")
+            return self._error(404, f"no route {self.path}", "invalid_request_error")
+
+        time.sleep(fake.latency())
+        outcome = fake.outcome()
+        fake.count(outcome)
+        if outcome == "429":
+            retry = ("retry-after-ms", str(int(fake.retry_after * 1000)))
+            return self._error(429, "Rate limit reached", "rate_limit_error", [retry])
+        if outcome in ("500", "502"):
+            return self._error(int(outcome), "The server had an error", "server_error")
+
+        text = MALFORMED_REPLY if outcome == "malformed" else fake.reply(request["messages"])
+        model = MODEL_NAMES.get(request["model"], request["model"])
+        prompt_tokens = sum(len(m.get("content") or "") for m in request["messages"]) // 4 + 1
+        usage = {"prompt_tokens": prompt_tokens, "completion_tokens": len(text) // 4 + 1}
+        usage["total_tokens"] = usage["prompt_tokens"] + usage["completion_tokens"]
+        if request.get("stream"):
+            self._stream(model, text, usage, (request.get("stream_options") or {}).get("include_usage"))
+        else:
+            self._send(200, {
+                "id": f"chatcmpl-{fake.next_id()}",
+                "object": "chat.completion",
+                "created": int(time.time()),
+                "model": model,
+                "choices": [{"index": 0, "message": {"role": "assistant", "content": text}, "finish_reason": "stop"}],
+                "usage": usage,
+            })
+
+    def _stream(self, model, text, usage, include_usage):
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        base = {"id": f"chatcmpl-{self.server.fake.next_id()}", "object": "chat.completion.chunk",
+                "created": int(time.time()), "model": model}
+        pieces = [text[i:i + 4] for i in range(0, len(text), 4)]
+        chunks = [{**base, "choices": [{"index": 0, "delta": {"content": p}, "finish_reason": None}]} for p in pieces]
+        chunks.append({**base, "choices": [{"index": 0, "delta": {}, "finish_reason": "stop"}]})
+        if include_usage:
+            chunks.append({**base, "choices": [], "usage": usage})
+        try:
+            for chunk in chunks:
+                self._chunk(f"data: {json.dumps(chunk)}\n\n")
+                time.sleep(self.server.fake.token_delay)
+            self._chunk("data: [DONE]\n\n")
+            self._chunk("")
+        except (BrokenPipeError, ConnectionResetError):
+            # The client closed the stream early
+            self.close_connection = True
+
+    def _chunk(self, data):
+        data = data.encode()
+        self.wfile.write(f"{len(data):x}\r\n".encode() + data + b"\r\n")
+        self.wfile.flush()
+
+
+class FakeOpenAIServer:
+    """
+    latency_median / latency_sigma: lognormal latency of each reply, seconds
+    rate_429 / rate_500 / rate_502: share of requests answered with that status
+    rate_malformed: share of replies that aren't valid JSON
+    retry_after: seconds sent in retry-after-ms with 429s
+    token_delay: seconds between streamed chunks
+    reply: reply(messages) -> reply text, defaults to a small JSON object
+    """
+
+    def __init__(
+        self,
+        host="127.0.0.1",
+        port=0,
+        latency_median=0.2,
+        latency_sigma=0.5,
+        rate_429=0.0,
+        rate_500=0.0,
+        rate_502=0.0,
+        rate_malformed=0.0,
+        retry_after=0.5,
+        token_delay=0.0,
+        reply=default_reply,
+        seed=None,
+    ):
+        self.latency_median = latency_median
+        self.latency_sigma = latency_sigma
+        self.rates = [("429", rate_429), ("500", rate_500), ("502", rate_502), ("malformed", rate_malformed)]
+        self.retry_after = retry_after
+        self.token_delay = token_delay
+        self.reply = reply
+        self.random = random.Random(seed)
+        self.counts = Counter()
+        self._lock = threading.Lock()
+        self._ids = 0
+        self.httpd = ThreadingHTTPServer((host, port), _Handler)
+        self.httpd.daemon_threads = True
+        self.httpd.fake = self
+        self.thread = None
+
+    @property
+    def url(self):
+        host, port = self.httpd.server_address[:2]
+        return f"http://{host}:{port}/v1"
+
+    def latency(self):
+        with self._lock:
+            return self.random.lognormvariate(0, self.latency_sigma) * self.latency_median
+
+    def outcome(self):
+        with self._lock:
+            r = self.random.random()
+        for outcome, rate in self.rates:
+            if r < rate:
+                return outcome
+            r -= rate
+        return "ok"
+
+    def count(self, outcome):
+        with self._lock:
+            self.counts[outcome] += 1
+
+    def next_id(self):
+        with self._lock:
+            self._ids += 1
+            return self._ids
+
+    def stats(self):
+        with self._lock:
+            return {"requests": sum(self.counts.values()), **self.counts}
+
+    def client(self, max_retries=0, **kwargs):
+        """An AsyncOpenAI pointed at this server, without the SDK's own retries by default"""
+        from openai import AsyncOpenAI
+
+        return AsyncOpenAI(base_url=self.url, api_key="fake", max_retries=max_retries, **kwargs)
+
+    def start(self):
+        self.thread = threading.Thread(target=self.httpd.serve_forever, name="fake-openai", daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Fake OpenAI chat completions server")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--latency-median", type=float, default=0.2)
+    parser.add_argument("--latency-sigma", type=float, default=0.5)
+    parser.add_argument("--rate-429", type=float, default=0.0)
+    parser.add_argument("--rate-500", type=float, default=0.0)
+    parser.add_argument("--rate-502", type=float, default=0.0)
+    parser.add_argument("--rate-malformed", type=float, default=0.0)
+    parser.add_argument("--retry-after", type=float, default=0.5)
+    args = parser.parse_args()
+    server = FakeOpenAIServer(**vars(args))
+    print(f"Serving fake OpenAI API at {server.url}")
+    try:
+        server.httpd.serve_forever()
+    except KeyboardInterrupt:
+        print(server.stats())
+
+
+if __name__ == "__main__":
+    main()
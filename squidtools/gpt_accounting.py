@@ -0,0 +1,168 @@
+import json
+import contextvars
+from contextlib import contextmanager
+from collections import defaultdict
+
+from .util import print_err
+
+"""
+Token and cost accounting for gpt_utils_async.
+
+Every chat completion (cache hits, aborted streams and batch results
+included) is reported to gpt_utils_async.accounting, which keeps tokens
+and dollars per model, per prompt template and for the whole run. Give it
+a budget to stop a run once that much has been spent:
+
+    accounting = RunAccounting(budget=25.0)
+    gpt_utils_async.set_accounting(accounting)
+    async_robust_task(objs, task, stop=accounting.exhausted)
+    accounting.snapshot()
+
+Past the budget every new request raises BudgetExceeded, and the stop=
+callable keeps robust_task from dispatching more items.
+
+Prices are per million tokens. A model is priced by the longest matching
+prefix in the table, so gpt-4o-2024-08-06 is priced as gpt-4o. Load your
+own with PriceTable.load("prices.json"), a file of
+{model: {"input": ..., "output": ...}}.
+
+Requests are grouped by template: the name set with
+`with template("classify"):`, or else the first line of the prompt.
+"""
+
+DEFAULT_PRICES = {
+    "gpt-4o-mini": {"input": 0.15, "output": 0.6},
+    "gpt-4o": {"input": 2.5, "output": 10},
+    "gpt-4-turbo": {"input": 10, "output": 30},
+    "gpt-4-1106-preview": {"input": 10, "output": 30},
+    "gpt-4-0613": {"input": 30, "output": 60},
+    "gpt-4": {"input": 30, "output": 60},
+    "gpt-3.5-turbo-16k-0613": {"input": 3, "output": 4},
+    "gpt-3.5-turbo-0613": {"input": 1.5, "output": 2},
+    "gpt-3.5-turbo-0125": {"input": 0.5, "output": 1.5},
+    "gpt-3.5-turbo": {"input": 0.5, "output": 1.5},
+}
+# Templates named after the prompt are cut to this many characters
+TEMPLATE_CHARS = 60
+
+
+class BudgetExceeded(Exception):
+    pass
+
+
+class PriceTable:
+    def __init__(self, prices=None):
+        self.prices = dict(DEFAULT_PRICES if prices is None else prices)
+        self._matches = {}
+
+    @classmethod
+    def load(cls, path, defaults=True):
+        """Prices from a JSON file, on top of DEFAULT_PRICES unless defaults=False"""
+        with open(path) as f:
+            prices = json.load(f)
+        return cls({**DEFAULT_PRICES, **prices} if defaults else prices)
+
+    def update(self, prices):
+        self.prices.update(prices)
+        self._matches.clear()
+
+    def price_for(self, model):
+        if model not in self._matches:
+            prefixes = [p for p in self.prices if model.startswith(p)]
+            self._matches[model] = self.prices[max(prefixes, key=len)] if prefixes else None
+        return self._matches[model]
+
+    def cost(self, model, prompt_tokens, completion_tokens):
+        """Dollars for a request, None if the model isn't priced"""
+        price = self.price_for(model)
+        if price is None:
+            return None
+        return (prompt_tokens * price["input"] + completion_tokens * price["output"]) / 1_000_000
+
+
+_template = contextvars.ContextVar("gpt_template", default=None)
+
+
+@contextmanager
+def template(name):
+    """Account requests made inside the block (and tasks started there) to name"""
+    token = _template.set(name)
+    try:
+        yield
+    finally:
+        _template.reset(token)
+
+
+def template_name(messages):
+    name = _template.get()
+    if name is None and messages:
+        name = (messages[0].get("content") or "").strip().split("\n", 1)[0][:TEMPLATE_CHARS]
+    return name
+
+
+def _totals():
+    return {"calls": 0, "cached": 0, "prompt_tokens": 0, "completion_tokens": 0, "cost": 0.0}
+
+
+class RunAccounting:
+    """
+    prices: a PriceTable, or a dict of prices for one
+    budget: dollars after which requests raise BudgetExceeded
+    name: label for the run in snapshots
+    """
+
+    def __init__(self, prices=None, budget=None, name=None):
+        self.prices = prices if isinstance(prices, PriceTable) else PriceTable(prices)
+        self.budget = budget
+        self.name = name
+        self.total = _totals()
+        self.models = defaultdict(_totals)
+        self.templates = defaultdict(_totals)
+        self.unpriced = set()
+
+    def record(self, model, usage, template=None, cached=False, discount=1.0):
+        """Count one response, returns its cost"""
+        cost = 0.0
+        if not cached:
+            cost = self.prices.cost(model, usage.prompt_tokens, usage.completion_tokens)
+            if cost is None:
+                if model not in self.unpriced:
+                    print_err(f"{model} has no price, add it to the price table")
+                    self.unpriced.add(model)
+                cost = 0.0
+            cost *= discount
+        for totals in (self.total, self.models[model], self.templates[template]):
+            totals["calls"] += 1
+            if cached:
+                totals["cached"] += 1
+            else:
+                totals["prompt_tokens"] += usage.prompt_tokens
+                totals["completion_tokens"] += usage.completion_tokens
+                totals["cost"] += cost
+        return cost
+
+    @property
+    def spent(self):
+        return self.total["cost"]
+
+    def exhausted(self):
+        return self.budget is not None and self.spent >= self.budget
+
+    def check(self):
+        if self.exhausted():
+            raise BudgetExceeded(f"spent ${self.spent:.2f} of the ${self.budget:.2f} budget")
+
+    def snapshot(self):
+        return {
+            "name": self.name,
+            "budget": self.budget,
+            "spent": self.spent,
+            "total": dict(self.total),
+            "models": {k: dict(v) for k, v in self.models.items()},
+            "templates": {k: dict(v) for k, v in self.templates.items()},
+            "unpriced": sorted(self.unpriced),
+        }
+
+    def save(self, path):
+        with open(path, "wt") as f:
+            json.dump(self.snapshot(), f, indent=2)
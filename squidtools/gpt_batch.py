@@ -0,0 +1,323 @@
+import os
+import json
+import asyncio
+import itertools
+from types import SimpleNamespace
+
+from . import gpt_utils_async as gpt
+from .gpt_limits import count_tokens, estimate_prompt_tokens
+from .gpt_accounting import template_name
+from .util import print_err
+
+"""
+Bulk prompting through the OpenAI Batch API.
+
+Batch jobs cost half as much as the chat endpoint and don't count against
+its rate limits, at the price of waiting (up to 24h) for results. The
+requests are written out as JSONL, uploaded and submitted, the job is
+polled until it finishes, and results are mapped back to the inputs by
+custom id. Requests that failed, or whose replies didn't parse / pass the
+schema, are resubmitted in a new batch, up to max_attempts times.
+
+    results, cost, failed = asyncio.run(batch_json_prompt(prompt, inputs, schema=check))
+
+inputs is a dict (results are keyed the same way) or a list (keyed by
+position). FakeBatchClient runs jobs locally for testing without the API:
+
+    client = FakeBatchClient(lambda messages, model: '{"name": "x"}')
+    asyncio.run(batch_json_prompt(prompt, inputs, client=client, poll_interval=0))
+"""
+
+BATCH_ENDPOINT = "/v1/chat/completions"
+# Batch jobs are billed at half the chat endpoint's price
+BATCH_DISCOUNT = 0.5
+# The API's limit on requests per batch file
+MAX_BATCH_REQUESTS = 50000
+DONE_STATUSES = ("completed", "failed", "expired", "cancelled")
+
+MESSAGE_BUILDERS = {
+    gpt.basic_prompt: gpt.basic_messages,
+    gpt.system_prompt: gpt.system_messages,
+    "basic": gpt.basic_messages,
+    "system": gpt.system_messages,
+}
+
+
+def custom_id(i):
+    return f"request-{i}"
+
+
+def batch_request(i, messages, model=gpt.DEFAULT_MODEL, temperature=gpt.TEMPERATURE):
+    return {
+        "custom_id": custom_id(i),
+        "method": "POST",
+        "url": BATCH_ENDPOINT,
+        "body": {"model": model, "temperature": temperature, "messages": messages},
+    }
+
+
+def write_batch_file(path, requests):
+    with open(path, "wt") as f:
+        for request in requests:
+            f.write(json.dumps(request) + "\n")
+
+
+
+async def submit_batch(path, client, completion_window="24h"):
+    with open(path, "rb") as f:
+        upload = await client.files.create(file=f, purpose="batch")
+    batch = await client.batches.create(
+        input_file_id=upload.id, endpoint=BATCH_ENDPOINT, completion_window=completion_window
+    )
+    print_err(f"Submitted batch {batch.id} ({path})")
+    return batch
+
+
+async def wait_for_batch(batch, client, poll_interval=60):
+    while batch.status not in DONE_STATUSES:
+        await asyncio.sleep(poll_interval)
+        batch = await client.batches.retrieve(batch.id)
+        counts = batch.request_counts
+        if counts is not None:
+            print_err(f"Batch {batch.id} {batch.status}: {counts.completed}/{counts.total} done, {counts.failed} failed")
+    if batch.status != "completed":
+        print_err(f"Batch {batch.id} ended {batch.status}")
+    return batch
+
+
+async def read_batch_output(batch, client):
+    """Returns {custom_id: (response, error)} for every request the batch has an answer for"""
+    outputs = {}
+    for file_id in (batch.output_file_id, batch.error_file_id):
+        if not file_id:
+            continue
+        content = await client.files.content(file_id)
+        for line in content.text.splitlines():
+            if not line.strip():
+                continue
+            result = json.loads(line)
+            response = result.get("response") or {}
+            if result.get("error"):
+                outputs[result["custom_id"]] = (None, result["error"])
+            elif response.get("status_code") != 200:
+                outputs[result["custom_id"]] = (None, response.get("body", {}).get("error", response))
+            else:
+                body = response["body"]
+                text = body["choices"][0]["message"]["content"]
+                outputs[result["custom_id"]] = (gpt.make_response(body["model"], text, body["usage"]), None)
+    return outputs
+
+
+async def _run_batches(
+    prompt, inputs, check, method, model, temperature, client, workdir, name, poll_interval, max_attempts, completion_window
+):
+    client = client or gpt.get_client()
+    build = MESSAGE_BUILDERS[method]
+    keys = list(inputs) if isinstance(inputs, dict) else range(len(inputs))
+    messages = [build(prompt, inputs[key]) for key in keys]
+
+    results = {}
+    best = {}
+    errors = {}
+    responses = []
+    pending = list(range(len(messages)))
+    for attempt in range(1, max_attempts + 1):
+        if not pending:
+            break
+        chunks = [pending[i : i + MAX_BATCH_REQUESTS] for i in range(0, len(pending), MAX_BATCH_REQUESTS)]
+        batches = []
+        gpt.accounting.check()
+        for n, chunk in enumerate(chunks):
+            path = os.path.join(workdir, f"{name}-{attempt}-{n}.jsonl")
+            write_batch_file(path, (batch_request(i, messages[i], model, temperature) for i in chunk))
+            batches.append(await submit_batch(path, client, completion_window))
+        batches = await asyncio.gather(*(wait_for_batch(b, client, poll_interval) for b in batches))
+        outputs = {}
+        for batch in batches:
+            outputs.update(await read_batch_output(batch, client))
+
+        retry = []
+        for i in pending:
+            response, err = outputs.get(custom_id(i), (None, "no result"))
+            if response is None:
+                errors[i] = err
+                retry.append(i)
+                continue
+            responses.append(response)
+            gpt.accounting.record(response.model, response.usage, template_name(messages[i]), discount=BATCH_DISCOUNT)
+            try:
+                score, value = check(gpt.get_message_text(response))
+            except json.decoder.JSONDecodeError as e:
+                errors[i] = e
+                retry.append(i)
+                continue
+            if score == 1:
+                results[keys[i]] = value
+                errors.pop(i, None)
+                best.pop(i, None)
+            else:
+                errors[i] = gpt.SchemaValidationError(value)
+                if score > best.get(i, (0, None))[0]:
+                    best[i] = (score, value)
+                retry.append(i)
+        if retry and attempt < max_attempts:
+            print_err(f"{len(retry)} of {len(pending)} requests failed, resubmitting ({attempt})")
+        pending = retry
+
+    # Like json_prompt, fall back to the best partial answer
+    failed = {}
+    for i in pending:
+        if i in best:
+            results[keys[i]] = best[i][1]
+        else:
+            failed[keys[i]] = errors[i]
+    cost = gpt.get_total_cost(responses)
+    return results, cost * BATCH_DISCOUNT if cost > 0 else cost, failed
+
+
+async def batch_prompt(
+    prompt,
+    inputs,
+    method=gpt.basic_prompt,
+    model=gpt.DEFAULT_MODEL,
+    temperature=gpt.TEMPERATURE,
+    client=None,
+    workdir=".",
+    name="batch",
+    poll_interval=60,
+    max_attempts=gpt.MAX_ATTEMPTS,
+    completion_window="24h",
+):
+    """
+    Batch version of basic_prompt / system_prompt (pick with method)
+    Returns (results, cost, failed), failed maps inputs that never got an
+    answer to the last error
+    """
+    return await _run_batches(
+        prompt, inputs, lambda text: (1, text), method, model, temperature,
+        client, workdir, name, poll_interval, max_attempts, completion_window,
+    )
+
+
+async def batch_json_prompt(
+    prompt,
+    inputs,
+    method=gpt.basic_prompt,
+    model=gpt.DEFAULT_MODEL,
+    schema=None,
+    temperature=gpt.TEMPERATURE,
+    client=None,
+    workdir=".",
+    name="batch",
+    poll_interval=60,
+    max_attempts=gpt.MAX_ATTEMPTS,
+    completion_window="24h",
+):
+    """
+    Batch version of json_prompt, with the same parsing and schema scoring
+    Replies that don't parse or score below 1 are resubmitted, after
+    max_attempts the best partial answer is used if there is one
+    """
+
+    def check(text):
+        serialized = gpt.parse_json(text)
+        return (schema(serialized) if schema else 1), serialized
+
+    return await _run_batches(
+        prompt, inputs, check, method, model, temperature,
+        client, workdir, name, poll_interval, max_attempts, completion_window,
+    )
+
+
+# Fake batch endpoint
+
+# The API answers with the dated model it resolved an alias to
+RESOLVED_MODELS = {"gpt-3.5-turbo": "gpt-3.5-turbo-0125", "gpt-4": "gpt-4-0613"}
+
+
+class FakeBatchClient:
+    """
+    Stands in for AsyncOpenAI's files / batches endpoints, answering every
+    request with responder(messages, model). Exceptions raised by responder
+    become per-request errors in the batch's error file. Jobs show as
+    in_progress for polls retrieves before completing.
+    """
+
+    def __init__(self, responder, polls=1):
+        self.responder = responder
+        self.polls = polls
+        self._ids = itertools.count()
+        self._files = {}
+        self._batches = {}
+        self.files = SimpleNamespace(create=self._create_file, content=self._file_content)
+        self.batches = SimpleNamespace(create=self._create_batch, retrieve=self._retrieve_batch)
+
+    def _id(self, prefix):
+        return f"{prefix}-{next(self._ids)}"
+
+    def _store(self, prefix, lines):
+        file_id = self._id(prefix)
+        self._files[file_id] = "".join(json.dumps(line) + "\n" for line in lines)
+        return file_id
+
+    async def _create_file(self, file, purpose):
+        file_id = self._id("file")
+        data = file.read() if hasattr(file, "read") else file
+        self._files[file_id] = data.decode() if isinstance(data, bytes) else data
+        return SimpleNamespace(id=file_id, purpose=purpose)
+
+    async def _file_content(self, file_id):
+        return SimpleNamespace(text=self._files[file_id])
+
+    def _answer(self, request):
+        body = request["body"]
+        try:
+            text = self.responder(body["messages"], body["model"])
+        except Exception as e:
+            return None, {"code": e.__class__.__name__, "message": str(e)}
+        prompt_tokens = estimate_prompt_tokens(body["messages"], body["model"])
+        completion_tokens = count_tokens(text, body["model"])
+        return {
+            "status_code": 200,
+            "body": {
+                "model": RESOLVED_MODELS.get(body["model"], body["model"]),
+                "choices": [{"index": 0, "message": {"role": "assistant", "content": text}}],
+                "usage": {
+                    "prompt_tokens": prompt_tokens,
+                    "completion_tokens": completion_tokens,
+                    "total_tokens": prompt_tokens + completion_tokens,
+                },
+            },
+        }, None
+
+    async def _create_batch(self, input_file_id, endpoint, completion_window, **kwargs):
+        output, errors = [], []
+        for line in self._files[input_file_id].splitlines():
+            request = json.loads(line)
+            response, err = self._answer(request)
+            result = {"id": self._id("response"), "custom_id": request["custom_id"], "response": response, "error": err}
+            (output if err is None else errors).append(result)
+        batch = SimpleNamespace(
+            id=self._id("batch"),
+            status="in_progress",
+            endpoint=endpoint,
+            input_file_id=input_file_id,
+            output_file_id=None,
+            error_file_id=None,
+            request_counts=SimpleNamespace(total=len(output) + len(errors), completed=0, failed=0),
+            polls=0,
+            results=(output, errors),
+        )
+        self._batches[batch.id] = batch
+        return batch
+
+    async def _retrieve_batch(self, batch_id):
+        batch = self._batches[batch_id]
+        batch.polls += 1
+        if batch.status == "in_progress" and batch.polls >= self.polls:
+            output, errors = batch.results
+            batch.output_file_id = self._store("file", output) if output else None
+            batch.error_file_id = self._store("file", errors) if errors else None
+            batch.request_counts = SimpleNamespace(total=len(output) + len(errors), completed=len(output), failed=len(errors))
+            batch.status = "completed"
+        return batch
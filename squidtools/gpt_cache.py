@@ -0,0 +1,163 @@
+import json
+import time
+import sqlite3
+import hashlib
+import functools
+import threading
+
+"""
+On-disk cache of chat completion responses for gpt_utils_async.
+
+Responses are keyed by a hash of the model, messages and temperature, and
+stored with their usage and cost in a sqlite file. Least recently used
+entries are evicted past max_entries / max_bytes, and entries older than
+max_age seconds are ignored.
+
+    gpt_utils_async.set_response_cache(ResponseCache("gpt_cache.db", max_bytes=2**30))
+
+Cache hits cost nothing, get_total_cost counts them as 0.
+"""
+
+
+def cache_key(model, messages, temperature):
+    payload = json.dumps([model, messages, temperature], sort_keys=True)
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+
+def _locked(method):
+    # The connection is shared between threads (eg gpt_utils' background
+    # loop and the thread that made the cache), one statement at a time
+    @functools.wraps(method)
+    def locked(self, *args, **kwargs):
+        with self._lock:
+            return method(self, *args, **kwargs)
+    return locked
+
+
+class ResponseCache:
+    """
+    path: sqlite file to keep the cache in
+    max_entries / max_bytes: evict least recently used entries past these
+    max_age: seconds after which an entry is treated as missing
+    """
+
+    def __init__(self, path="gpt_cache.db", max_entries=None, max_bytes=None, max_age=None):
+        self.path = path
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.saved_cost = 0.0
+        self._lock = threading.RLock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute(
+            """CREATE TABLE IF NOT EXISTS responses (
+                key TEXT PRIMARY KEY,
+                model TEXT,
+                text TEXT,
+                usage TEXT,
+                cost REAL,
+                size INTEGER,
+                created REAL,
+                accessed REAL
+            )"""
+        )
+        self.conn.execute("CREATE INDEX IF NOT EXISTS responses_accessed ON responses (accessed)")
+        self.conn.commit()
+        self.entries, self.bytes = self.conn.execute(
+            "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM responses"
+        ).fetchone()
+        # Expired entries are skipped by get(), they're only deleted here
+        self.purge_expired()
+
+    @_locked
+    def get(self, model, messages, temperature):
+        key = cache_key(model, messages, temperature)
+        row = self.conn.execute(
+            "SELECT model, text, usage, cost, created FROM responses WHERE key = ?", (key,)
+        ).fetchone()
+        now = time.time()
+        if row is None or (self.max_age is not None and now - row[4] > self.max_age):
+            self.misses += 1
+            return None
+        self.conn.execute("UPDATE responses SET accessed = ? WHERE key = ?", (now, key))
+        self.conn.commit()
+        self.hits += 1
+        self.saved_cost += max(row[3], 0)
+        return {"model": row[0], "text": row[1], "usage": json.loads(row[2]), "cost": row[3]}
+
+    @_locked
+    def put(self, model, messages, temperature, text, usage, cost):
+        key = cache_key(model, messages, temperature)
+        size = len(text.encode()) if text else 0
+        now = time.time()
+        old = self.conn.execute("SELECT size FROM responses WHERE key = ?", (key,)).fetchone()
+        self.conn.execute(
+            "INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            (key, model, text, json.dumps(usage), cost, size, now, now),
+        )
+        self.conn.commit()
+        if old:
+            self.bytes -= old[0]
+        else:
+            self.entries += 1
+        self.bytes += size
+        self.evict()
+
+    @_locked
+    def purge_expired(self):
+        if self.max_age is not None:
+            cur = self.conn.execute(
+                "DELETE FROM responses WHERE created < ? RETURNING size", (time.time() - self.max_age,)
+            )
+            self._evicted(cur.fetchall())
+            self.conn.commit()
+
+    @_locked
+    def evict(self):
+        while (self.max_entries is not None and self.entries > self.max_entries) or (
+            self.max_bytes is not None and self.bytes > self.max_bytes
+        ):
+            # Least recently used first, over the byte limit a few at a time
+            over = self.entries - self.max_entries if self.max_entries is not None else 0
+            n = over if over > 0 else max(1, self.entries // 100)
+            cur = self.conn.execute(
+                """DELETE FROM responses WHERE key IN
+                (SELECT key FROM responses ORDER BY accessed LIMIT ?) RETURNING size""",
+                (n,),
+            )
+            rows = cur.fetchall()
+            if not rows:
+                break
+            self._evicted(rows)
+        self.conn.commit()
+
+    def _evicted(self, rows):
+        self.entries -= len(rows)
+        self.bytes -= sum(size for (size,) in rows)
+        self.evictions += len(rows)
+
+    @_locked
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else None,
+            "entries": self.entries,
+            "bytes": self.bytes,
+            "evictions": self.evictions,
+            "saved_cost": self.saved_cost,
+        }
+
+    @_locked
+    def clear(self):
+        self.conn.execute("DELETE FROM responses")
+        self.conn.commit()
+        self.entries = self.bytes = 0
+
+    @_locked
+    def close(self):
+        self.conn.close()
@@ -0,0 +1,144 @@
+import time
+import asyncio
+import functools
+from collections import deque
+
+"""
+Tokens-per-minute / requests-per-minute budget for concurrent OpenAI calls.
+
+Before each request TokenBudget estimates its size (prompt tokens plus an
+allowance for the completion) and waits until it fits in the last minute's
+budget for that model. Once the response arrives the estimate is replaced
+with the actual usage, so the budget tracks what the API is really counting.
+
+    gpt_utils_async.set_token_budget(TokenBudget(
+        tpm=200_000, rpm=5_000,
+        limits={"gpt-4o": {"tpm": 30_000, "rpm": 500}},
+    ))
+
+Prompt tokens are counted with tiktoken when it's installed, otherwise
+estimated at about 4 characters per token.
+"""
+
+CHARS_PER_TOKEN = 4
+# Every message is wrapped in a few formatting tokens, plus the reply primer
+TOKENS_PER_MESSAGE = 4
+TOKENS_PER_REPLY = 3
+
+
+@functools.lru_cache(maxsize=None)
+def _encoding(model):
+    try:
+        import tiktoken
+    except ImportError:
+        return None
+    try:
+        return tiktoken.encoding_for_model(model)
+    except KeyError:
+        return tiktoken.get_encoding("cl100k_base")
+
+
+def count_tokens(text, model):
+    encoding = _encoding(model)
+    if encoding is None:
+        return len(text) // CHARS_PER_TOKEN + 1
+    return len(encoding.encode(text))
+
+
+def estimate_prompt_tokens(messages, model):
+    return TOKENS_PER_REPLY + sum(
+        TOKENS_PER_MESSAGE + count_tokens(m.get("content") or "", model) for m in messages
+    )
+
+
+class _Window:
+    # Requests started in the last window seconds for one model, as
+    # [start time, tokens] entries so reconcile can correct them in place
+    def __init__(self, tpm, rpm):
+        self.tpm = tpm
+        self.rpm = rpm
+        self.entries = deque()
+        self.tokens = 0
+
+    def prune(self, now, window):
+        while self.entries and self.entries[0][0] <= now - window:
+            self.tokens -= self.entries.popleft()[1]
+
+    def fits(self, tokens):
+        if not self.entries:
+            # Always let a request through on an empty window, even if it's
+            # bigger than the whole budget
+            return True
+        if self.rpm is not None and len(self.entries) + 1 > self.rpm:
+            return False
+        return self.tpm is None or self.tokens + tokens <= self.tpm
+
+
+class TokenBudget:
+    """
+    tpm / rpm: default tokens and requests per minute for every model
+    limits: per-model overrides, {model: {"tpm": ..., "rpm": ...}}
+    completion_tokens: tokens reserved for each response until its usage is known
+    """
+
+    def __init__(self, tpm=None, rpm=None, limits=None, completion_tokens=256, window=60):
+        self.tpm = tpm
+        self.rpm = rpm
+        self.limits = limits or {}
+        self.completion_tokens = completion_tokens
+        self.window = window
+        self.windows = {}
+        self.waits = 0
+        self.estimated = 0
+        self.actual = 0
+
+    def _window(self, model):
+        if model not in self.windows:
+            limit = self.limits.get(model, {})
+            self.windows[model] = _Window(limit.get("tpm", self.tpm), limit.get("rpm", self.rpm))
+        return self.windows[model]
+
+    def estimate(self, model, messages):
+        return estimate_prompt_tokens(messages, model) + self.completion_tokens
+
+    async def acquire(self, model, messages):
+        """Wait until the request fits in the budget, returns a ticket for reconcile"""
+        tokens = self.estimate(model, messages)
+        window = self._window(model)
+        while True:
+            now = time.monotonic()
+            window.prune(now, self.window)
+            if window.fits(tokens):
+                break
+            self.waits += 1
+            await asyncio.sleep(max(0.01, window.entries[0][0] + self.window - now))
+        ticket = [now, tokens, model]
+        window.entries.append(ticket)
+        window.tokens += tokens
+        self.estimated += tokens
+        return ticket
+
+    def reconcile(self, ticket, usage):
+        """Replace the estimate for a request with the tokens it actually used"""
+        if usage is None:
+            return
+        actual = usage.total_tokens
+        self.actual += actual
+        window = self._window(ticket[2])
+        # Only adjust the running total if the entry hasn't aged out yet
+        if window.entries and ticket[0] >= window.entries[0][0]:
+            window.tokens += actual - ticket[1]
+        ticket[1] = actual
+
+    def state(self):
+        now = time.monotonic()
+        state = {}
+        for model, window in self.windows.items():
+            window.prune(now, self.window)
+            state[model] = {
+                "tokens": window.tokens,
+                "requests": len(window.entries),
+                "tpm": window.tpm,
+                "rpm": window.rpm,
+            }
+        return {"models": state, "waits": self.waits, "estimated": self.estimated, "actual": self.actual}
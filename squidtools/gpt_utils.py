@@ -1,17 +1,68 @@
 import asyncio
+import threading
 from . import gpt_utils_async
 
 DEFAULT_MODEL = 'gpt-3.5-turbo'
 
+# Every sync call runs on one long-lived event loop in a background thread,
+# so the async client's connection pool is reused across calls (and this
+# works from inside notebooks, where a loop is already running)
+_loop = None
+_loop_lock = threading.Lock()
+
+def _get_loop():
+    global _loop
+    with _loop_lock:
+        if _loop is None:
+            _loop = asyncio.new_event_loop()
+            threading.Thread(target=_loop.run_forever, name="gpt_utils-loop", daemon=True).start()
+    return _loop
+
+def run(coro):
+    """Run a coroutine on the background loop and wait for its result"""
+    return asyncio.run_coroutine_threadsafe(coro, _get_loop()).result()
+
 
 # utility functions for handling open AI responses
 def basic_prompt(prompt, input, model=DEFAULT_MODEL):
-    return asyncio.run(gpt_utils_async.basic_prompt(prompt, input, model))
+    return run(gpt_utils_async.basic_prompt(prompt, input, model))
 
 def system_prompt(prompt, input, model=DEFAULT_MODEL):
-    return asyncio.run(gpt_utils_async.system_prompt(prompt, input, model))
+    return run(gpt_utils_async.system_prompt(prompt, input, model))
+
+def json_prompt(prompt_text, input, method=basic_prompt, model=DEFAULT_MODEL, schema=None, candidates=1, **kwargs):
+    return run(gpt_utils_async.json_prompt(prompt_text, input, _async(method), model, schema, candidates, **kwargs))
+
+def json_prompt_packed(prompt_text, inputs, method=basic_prompt, model=DEFAULT_MODEL, schema=None, **kwargs):
+    return run(gpt_utils_async.json_prompt_packed(prompt_text, inputs, _async(method), model, schema, **kwargs))
+
+# Sync methods are swapped for their async versions on the loop
+ASYNC_METHODS = {
+    basic_prompt: gpt_utils_async.basic_prompt,
+    system_prompt: gpt_utils_async.system_prompt,
+    json_prompt: gpt_utils_async.json_prompt,
+}
+
+def _async(method):
+    return ASYNC_METHODS.get(method, method)
+
+async def _map(method, prompt, inputs, concurrency, return_exceptions, kwargs):
+    semaphore = asyncio.Semaphore(concurrency)
 
-def json_prompt(prompt_text, input, method=basic_prompt, model=DEFAULT_MODEL, schema=None):
-    return asyncio.run(gpt_utils_async.json_prompt(prompt_text, input, method, model, schema))
+    async def one(input):
+        async with semaphore:
+            return await method(prompt, input, **kwargs)
 
+    return await asyncio.gather(*(one(input) for input in inputs), return_exceptions=return_exceptions)
 
+def map_prompts(prompt, inputs, method=basic_prompt, model=DEFAULT_MODEL, concurrency=8,
+                return_exceptions=False, **kwargs):
+    """
+    Run method(prompt, input) for every input, up to concurrency at a time
+    Returns the results in the same order as inputs. extra kwargs (eg
+    schema= for json_prompt) are passed to method. With return_exceptions
+    failed inputs get their exception in place of a result instead of
+    raising.
+    """
+    return run(_map(_async(method), prompt, list(inputs), concurrency, return_exceptions,
+                    {"model": model, **kwargs}))
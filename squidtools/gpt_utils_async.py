@@ -1,97 +1,553 @@
 import os
 import json
 import time
+import random
+import threading
+import asyncio
+import functools
+import contextvars
+from contextlib import contextmanager
+from types import SimpleNamespace
+from email.utils import parsedate_to_datetime
 from .util import print_err
+from .gpt_limits import count_tokens, estimate_prompt_tokens
+from .json_stream import JSONPrefixValidator, StreamAbort
+from .gpt_accounting import RunAccounting, BudgetExceeded, template_name
+from .util import lazy
 
-from openai  import AsyncOpenAI
-from openai import _exceptions as error
+# openai takes about a second to import, so it's only imported when needed
+@lazy
+def openai_errors():
+    from openai import _exceptions
+    return _exceptions
 
-client = AsyncOpenAI(api_key=os.environ["OPENAI_KEY"])
+def __getattr__(name):
+    # gpt_utils_async.error still works
+    if name == "error":
+        return openai_errors()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+# Created on first use, so importing doesn't need OPENAI_KEY. Set
+# OPENAI_BASE_URL (or call set_client_factory) to talk to another server,
+# eg fake_openai.FakeOpenAIServer.
+# A client set with set_client (or assigned to client) is used everywhere,
+# otherwise each event loop gets its own client from client_factory: the
+# client's connections belong to the loop they were opened on, and
+# gpt_utils' background loop and asyncio.run loops can be alive at once
+client = None
+_clients = {}
+_client_lock = threading.Lock()
+
+def default_client():
+    from openai import AsyncOpenAI
+    return AsyncOpenAI(api_key=os.environ.get("OPENAI_KEY") or os.environ.get("OPENAI_API_KEY"),
+                       base_url=os.environ.get("OPENAI_BASE_URL"))
+
+client_factory = default_client
+
+async def _close_with_loop(loop_client):
+    # An async generator left open is closed by asyncio.run (shutdown_asyncgens)
+    # while its loop is still running, which is the last chance to close the
+    # client's connections; after that they'd be cleaned up on a dead loop
+    try:
+        yield
+    finally:
+        await loop_client.close()
+
+def _closing(loop_client):
+    closer = _close_with_loop(loop_client)
+    # Run it up to the yield, this registers it with the running loop
+    try:
+        closer.asend(None).send(None)
+    except StopIteration:
+        pass
+    return closer
+
+def get_client():
+    if client is not None or client_factory is None:
+        return client
+    try:
+        loop = asyncio.get_running_loop()
+    except RuntimeError:
+        loop = None
+    with _client_lock:
+        # Clients of closed loops (eg earlier asyncio.run calls) can't be used again
+        for closed in [l for l in _clients if l is not None and l.is_closed()]:
+            del _clients[closed]
+        if loop not in _clients:
+            new_client = client_factory()
+            # The loop only keeps a weak reference to the generator
+            _clients[loop] = (new_client, _closing(new_client) if loop is not None else None)
+        return _clients[loop][0]
+
+def set_client_factory(factory):
+    """Use factory() to create clients from now on"""
+    global client, client_factory
+    with _client_lock:
+        client_factory = factory
+        client = None
+        _clients.clear()
+
+def set_client(new_client):
+    """Use new_client as is, on every loop, it's never replaced"""
+    global client, client_factory
+    with _client_lock:
+        client = new_client
+        client_factory = None
+        _clients.clear()
 
 MAX_ATTEMPTS = 5
 DEFAULT_MODEL = 'gpt-3.5-turbo'
+TEMPERATURE = 0.5
+
+# Optional gpt_cache.ResponseCache in front of every chat completion
+response_cache = None
+
+def set_response_cache(cache):
+    global response_cache
+    response_cache = cache
+
+_cache_policy = contextvars.ContextVar("gpt_cache_policy", default=(True, None))
+
+@contextmanager
+def cache_policy(use_cache=True, accept=None):
+    """
+    Requests made inside the block (and tasks started there) only look in
+    response_cache if use_cache, and only replies accept(text) returns True
+    for are put in it
+    """
+    token = _cache_policy.set((use_cache, accept))
+    try:
+        yield
+    finally:
+        _cache_policy.reset(token)
+
+# Optional gpt_limits.TokenBudget every request has to fit into
+token_budget = None
+
+def set_token_budget(budget):
+    global token_budget
+    token_budget = budget
+
+# Every response is counted here, see gpt_accounting
+accounting = RunAccounting()
+
+def set_accounting(run_accounting):
+    global accounting
+    accounting = run_accounting
+
+# When any request gets rate limited, every request in the process waits
+# until this time (time.monotonic) before hitting the API again
+cooldown_until = 0.0
+# Spread requests out a little when a cooldown ends
+COOLDOWN_JITTER = 1.0
 
 class SchemaValidationError(Exception):
     pass
 
 # Main interface are these prompting strats
 
-async def basic_prompt(prompt, input, model=DEFAULT_MODEL):
-    messages = [{"role": "user", "content": f"{prompt}\n{input}"}]
-    response = await generate_chat_response(messages, model)
-    return get_message_text(response), get_total_cost([response])
+def basic_messages(prompt, input):
+    return [{"role": "user", "content": f"{prompt}\n{input}"}]
 
-async def system_prompt(prompt, input, model=DEFAULT_MODEL):
-    messages = [
+def system_messages(prompt, input):
+    return [
         {"role": "system", "content": prompt},
         {"role": "user", "content": input}
     ]
-    response = await generate_chat_response(messages, model)
-    return get_message_text(response), get_total_cost([response])
 
-async def json_prompt(prompt_text, input, method=basic_prompt, model=DEFAULT_MODEL, schema=None, attempt=1, best=(0,None)):
-    response_txt, cost = await method(prompt_text, input, model)
+def parse_json(response_txt):
+    # Models like to wrap JSON in markdown fences
     response_txt = response_txt.replace('```json', '').replace('```', '').strip()
-    try: 
-        serialized = json.loads(response_txt)
-    except json.decoder.JSONDecodeError as e:
-        if attempt < MAX_ATTEMPTS:
-            print_err(f"JSON decode error, retrying ({attempt})")
-            return await json_prompt(prompt_text, input, method, model, schema, attempt + 1, best)
-        else:
-            raise e
-    # Schema is a method that returns a value between 0 and 1
-    # 1 indicates full compliance with the schema
-    # 0 indicates non compliance with the schema
-    # In between values indicate partial compliance
-    # The code will retry until the schema check returns 1, saving the "best so far"
-    # If MAX ATTEMPTS is reached, then we return the "best so far" 
-    # If it's None then raise an exception
-    # TBD if we should return None instead, could be useful either way 
-    if schema:
-        check = schema(serialized)
-        if check != 1:
-            if attempt < MAX_ATTEMPTS:
+    return json.loads(response_txt)
+
+# extra kwargs (stream=, on_token=, validator=) go to generate_chat_response
+async def basic_prompt(prompt, input, model=DEFAULT_MODEL, **kwargs):
+    messages = basic_messages(prompt, input)
+    response = await generate_chat_response(messages, model, **kwargs)
+    return get_message_text(response), get_total_cost([response])
+
+async def system_prompt(prompt, input, model=DEFAULT_MODEL, **kwargs):
+    messages = system_messages(prompt, input)
+    response = await generate_chat_response(messages, model, **kwargs)
+    return get_message_text(response), get_total_cost([response])
+
+def add_cost(total, cost):
+    # get_total_cost returns -1 for unknown models, keep that visible
+    return -1 if total < 0 or cost < 0 else total + cost
+
+async def json_prompt(prompt_text, input, method=basic_prompt, model=DEFAULT_MODEL, schema=None, candidates=1,
+                      stream=False, on_token=None, required_keys=None, ordered=False):
+    """
+    Prompt for JSON, retrying until it parses and passes schema
+    Schema is a method that returns a value between 0 and 1
+    1 indicates full compliance with the schema
+    0 indicates non compliance with the schema
+    In between values indicate partial compliance
+    Up to MAX_ATTEMPTS calls are made, candidates of them at a time
+    concurrently, and the first reply that scores 1 is returned. Otherwise
+    the best partial reply is returned, and if there isn't one the last
+    error is raised. Returns (serialized, cost of every call made)
+    With stream, replies are streamed (on_token sees the pieces) and a
+    reply is abandoned as soon as it can't be valid JSON with required_keys,
+    or, if ordered, as soon as it skips one of required_keys (in order)
+    Only replies that parse and score 1 go in the response cache, and only
+    the first round looks there, so retries always ask the API again
+    """
+    best = (0, None)
+    cost = 0
+    last_error = None
+    attempt = 0
+
+    def accept(response_txt):
+        try:
+            serialized = parse_json(response_txt)
+        except json.decoder.JSONDecodeError:
+            return False
+        return (schema(serialized) if schema else 1) == 1
+
+    kwargs = {}
+    if stream:
+        kwargs = {"stream": True, "on_token": on_token,
+                  "validator": functools.partial(JSONPrefixValidator, required_keys, ordered)}
+    while attempt < MAX_ATTEMPTS:
+        n = max(1, min(candidates, MAX_ATTEMPTS - attempt))
+        with cache_policy(use_cache=attempt == 0, accept=accept):
+            tasks = [asyncio.ensure_future(method(prompt_text, input, model, **kwargs)) for _ in range(n)]
+        try:
+            for next_reply in asyncio.as_completed(tasks):
+                try:
+                    response_txt, c = await next_reply
+                except StreamAbort as e:
+                    attempt += 1
+                    cost = add_cost(cost, get_total_cost([e.response]))
+                    print_err(f"Stream aborted, retrying ({attempt}): {e.reason}")
+                    last_error = e
+                    continue
+                attempt += 1
+                cost = add_cost(cost, c)
+                try:
+                    serialized = parse_json(response_txt)
+                except json.decoder.JSONDecodeError as e:
+                    print_err(f"JSON decode error, retrying ({attempt})")
+                    last_error = e
+                    continue
+                check = schema(serialized) if schema else 1
+                if check == 1:
+                    return serialized, cost
                 print_err(f"Schema check failed, retrying ({attempt}) ({serialized})")
                 if check > best[0]:
                     best = (check, serialized)
-                return await json_prompt(prompt_text, input, method, model, schema, attempt + 1, best)
+                last_error = SchemaValidationError(serialized)
+        finally:
+            # Once one candidate passes the others aren't needed
+            for task in tasks:
+                task.cancel()
+    if best[1] is not None:
+        return best[1], cost
+    raise last_error
+
+async def json_prompt_system(prompt_text, input, model=DEFAULT_MODEL, schema=None, candidates=1, **kwargs):
+    return await json_prompt(prompt_text, input, method=system_prompt, model=model, schema=schema,
+                             candidates=candidates, **kwargs)
+
+# Packed mode, several inputs per request
+
+PACKED_INSTRUCTIONS = """
+You will be given several items as a JSON object mapping item ids to inputs.
+Handle each item separately, following the instructions above, and respond with
+a single JSON object mapping every item id to the JSON response for that item."""
+
+class PackSize:
+    """
+    Number of inputs per packed request, adjusted as results come back:
+    grows by increase after a round with no failures, multiplied by
+    decrease when more than threshold of a round's items fail. Share one
+    between json_prompt_packed calls to carry what it learned over.
+    """
+
+    def __init__(self, start=8, min_size=1, max_size=32, increase=1, decrease=0.5, threshold=0.2):
+        self.size = start
+        self.min_size = min_size
+        self.max_size = max_size
+        self.increase = increase
+        self.decrease = decrease
+        self.threshold = threshold
+
+    def observe(self, failed, total):
+        if not total:
+            return
+        if failed / total > self.threshold:
+            self.size = max(self.min_size, int(self.size * self.decrease))
+        elif failed == 0:
+            self.size = min(self.max_size, self.size + self.increase)
+
+def packed_input(inputs):
+    return json.dumps({str(n + 1): input for n, input in enumerate(inputs)}, ensure_ascii=False, indent=1)
+
+async def json_prompt_packed(prompt_text, inputs, method=basic_prompt, model=DEFAULT_MODEL, schema=None,
+                             pack_size=8, max_attempts=MAX_ATTEMPTS, retry_unpacked=False,
+                             concurrency=4, return_exceptions=False):
+    """
+    json_prompt over many inputs, pack_size (an int or a PackSize) of them
+    per request. The response is split per item and each item is checked
+    with schema on its own; only the items that fail are sent again,
+    re-packed, or one at a time through json_prompt if retry_unpacked.
+    Returns (results in input order, cost). Items that never pass get their
+    best partial result, or raise (or, with return_exceptions, get the
+    exception in their place).
+    """
+    inputs = list(inputs)
+    if not isinstance(pack_size, PackSize):
+        pack_size = PackSize(start=pack_size, max_size=max(pack_size, 32))
+    packed_prompt = f"{prompt_text}\n{PACKED_INSTRUCTIONS}"
+    semaphore = asyncio.Semaphore(concurrency)
+    results = {}
+    best = {}
+    errors = {}
+    attempts = [0] * len(inputs)
+    cost = 0
+
+    def accept(response_txt):
+        try:
+            return isinstance(parse_json(response_txt), dict)
+        except json.decoder.JSONDecodeError:
+            return False
+
+    async def send(pack, first):
+        async with semaphore:
+            with cache_policy(use_cache=first, accept=accept):
+                response_txt, c = await method(packed_prompt, packed_input([inputs[i] for i in pack]), model)
+        try:
+            serialized = parse_json(response_txt)
+        except json.decoder.JSONDecodeError as e:
+            serialized = e
+        return pack, serialized, c
+
+    def check(i, item_id, serialized):
+        if isinstance(serialized, Exception):
+            return serialized
+        if not isinstance(serialized, dict) or item_id not in serialized:
+            return SchemaValidationError(f"item {item_id} missing from packed response")
+        value = serialized[item_id]
+        score = schema(value) if schema else 1
+        if score == 1:
+            results[i] = value
+            return None
+        if score > best.get(i, (0, None))[0]:
+            best[i] = (score, value)
+        return SchemaValidationError(value)
+
+    queue = list(range(len(inputs)))
+    first = True
+    while queue:
+        k = max(1, pack_size.size)
+        packs = [queue[j:j + k] for j in range(0, len(queue), k)]
+        retry = []
+        failed = 0
+        for pack, serialized, c in await asyncio.gather(*(send(pack, first) for pack in packs)):
+            cost = add_cost(cost, c)
+            for n, i in enumerate(pack):
+                attempts[i] += 1
+                err = check(i, str(n + 1), serialized)
+                if err is not None:
+                    errors[i] = err
+                    failed += 1
+                    if attempts[i] < max_attempts:
+                        retry.append(i)
+        pack_size.observe(failed, len(queue))
+        if failed:
+            print_err(f"{failed} of {len(queue)} packed items failed, retrying {len(retry)} (pack size {pack_size.size})")
+        queue = retry
+        first = False
+        if retry_unpacked:
+            break
+
+    if retry_unpacked and queue:
+        async def unpacked(i):
+            async with semaphore:
+                try:
+                    return i, await json_prompt(prompt_text, inputs[i], method, model, schema)
+                except (json.decoder.JSONDecodeError, SchemaValidationError) as e:
+                    return i, e
+        for i, result in await asyncio.gather(*(unpacked(i) for i in queue)):
+            if isinstance(result, Exception):
+                errors[i] = result
             else:
-                if best[1]:
-                    return best[1]
-                else:
-                    raise SchemaValidationError
-    return serialized, cost
+                results[i], c = result
+                cost = add_cost(cost, c)
+
+    out = []
+    for i in range(len(inputs)):
+        if i in results:
+            out.append(results[i])
+        elif i in best:
+            out.append(best[i][1])
+        elif return_exceptions:
+            out.append(errors[i])
+        else:
+            raise errors[i]
+    return out, cost
 
-async def json_prompt_system(prompt_text, input, model=DEFAULT_MODEL, schema=None):
-    return await json_prompt(prompt_text, input, method=system_prompt, model=model, schema=schema)
+def retry_after(e):
+    # Seconds the server asked us to wait for, if it said
+    response = getattr(e, "response", None)
+    headers = getattr(response, "headers", None) or {}
+    try:
+        if headers.get("retry-after-ms"):
+            return float(headers["retry-after-ms"]) / 1000
+        if headers.get("retry-after"):
+            return float(headers["retry-after"])
+    except ValueError:
+        try:
+            # Retry-After can also be an HTTP date
+            return max(0, parsedate_to_datetime(headers["retry-after"]).timestamp() - time.time())
+        except (TypeError, ValueError):
+            pass
+    return None
+
+def is_retryable(e):
+    error = openai_errors()
+    if isinstance(e, (error.InternalServerError, error.APITimeoutError, error.APIConnectionError,
+                      error.UnprocessableEntityError, error.RateLimitError)):
+        return True
+    if isinstance(e, error.APIStatusError) and e.status_code in (502, 503, 504):
+        return True
+    # bad gateway, we retry
+    return isinstance(e, error.APIError) and "bad gateway" in str(e).lower()
+
+def start_cooldown(seconds):
+    global cooldown_until
+    cooldown_until = max(cooldown_until, time.monotonic() + seconds)
+
+async def wait_for_cooldown():
+    waited = False
+    while (wait := cooldown_until - time.monotonic()) > 0:
+        waited = True
+        await asyncio.sleep(wait)
+    if waited:
+        await asyncio.sleep(random.random() * COOLDOWN_JITTER)
 
-async def generate_chat_response(messages, model=DEFAULT_MODEL, attempt=0):
+def make_response(model, text, usage, cached=False):
+    """
+    Just enough of the openai response shape for get_message_text & co, for
+    streamed, cached and batch responses. usage: prompt_tokens,
+    completion_tokens and total_tokens, as attributes or a dict
+    """
+    if isinstance(usage, dict):
+        usage = SimpleNamespace(**usage)
+    return SimpleNamespace(
+        model=model,
+        usage=usage,
+        choices=[SimpleNamespace(message=SimpleNamespace(content=text))],
+        cached=cached,
+    )
+
+def _estimated_usage(messages, model, text):
+    # An aborted stream never gets its usage chunk
+    prompt_tokens = estimate_prompt_tokens(messages, model)
+    completion_tokens = count_tokens(text, model) if text else 0
+    return SimpleNamespace(prompt_tokens=prompt_tokens, completion_tokens=completion_tokens,
+                           total_tokens=prompt_tokens + completion_tokens)
+
+async def stream_chat_response(messages, model=DEFAULT_MODEL, temperature=TEMPERATURE,
+                               on_token=None, validator=None):
+    """
+    One streamed completion, on_token(piece, text so far) is called as
+    tokens arrive and validator (eg a JSONPrefixValidator) is fed every
+    piece. When the validator raises StreamAbort the stream is closed
+    and the abort re-raised with an estimated-usage response attached
+    """
+    stream = await get_client().chat.completions.create(model=model,
+        temperature=temperature,
+        messages=messages,
+        stream=True,
+        stream_options={"include_usage": True})
+    text = ""
+    response_model = model
+    usage = None
     try:
-        response = await client.chat.completions.create(model=model,
-        temperature=0.5,
-        messages=messages)
-        return response
-    except (error.InternalServerError, error.APITimeoutError, error.UnprocessableEntityError, error.RateLimitError) as e:
-        attempt += 1
-        if attempt > MAX_ATTEMPTS:
+        async for chunk in stream:
+            response_model = chunk.model or response_model
+            if chunk.usage is not None:
+                usage = chunk.usage
+            if not chunk.choices or not chunk.choices[0].delta.content:
+                continue
+            piece = chunk.choices[0].delta.content
+            text += piece
+            if on_token is not None:
+                on_token(piece, text)
+            if validator is not None:
+                validator.feed(piece)
+    except StreamAbort as e:
+        await stream.close()
+        e.response = make_response(response_model, text, _estimated_usage(messages, model, text))
+        raise
+    return make_response(response_model, text, usage or _estimated_usage(messages, model, text))
+
+async def generate_chat_response(messages, model=DEFAULT_MODEL, temperature=TEMPERATURE,
+                                 stream=False, on_token=None, validator=None):
+    """
+    stream: stream the completion through stream_chat_response
+    validator: called with no arguments to make a fresh validator for each
+    streamed attempt, eg functools.partial(JSONPrefixValidator, required_keys)
+    response_cache is used as cache_policy says
+    """
+    use_cache, accept = _cache_policy.get()
+    if response_cache is not None and use_cache:
+        entry = response_cache.get(model, messages, temperature)
+        if entry is not None:
+            response = make_response(entry["model"], entry["text"], entry["usage"], cached=True)
+            accounting.record(response.model, response.usage, template_name(messages), cached=True)
+            if on_token is not None:
+                on_token(entry["text"], entry["text"])
+            return response
+    error = openai_errors()
+    attempt = 0
+    while True:
+        await wait_for_cooldown()
+        # Stop spending once the budget is gone, retries included
+        accounting.check()
+        if token_budget is not None:
+            ticket = await token_budget.acquire(model, messages)
+        try:
+            if stream:
+                response = await stream_chat_response(messages, model, temperature, on_token,
+                                                      validator() if validator else None)
+            else:
+                response = await get_client().chat.completions.create(model=model,
+                temperature=temperature,
+                messages=messages)
+            if token_budget is not None:
+                token_budget.reconcile(ticket, response.usage)
+            break
+        except StreamAbort as e:
+            accounting.record(e.response.model, e.response.usage, template_name(messages))
+            if token_budget is not None:
+                token_budget.reconcile(ticket, e.response.usage)
             raise e
-        sleeptime = pow(2, attempt + 1)
-        print_err("Service Unavailable.. sleeping for " + str(sleeptime))
-        time.sleep(sleeptime)
-        return await generate_chat_response(messages, model, attempt)
-    except error.APIError as e:
-        if "bad gateway" in str(e).lower():
-            # bad gateway, we retry
+        except error.APIError as e:
+            if not is_retryable(e):
+                raise e
             attempt += 1
             if attempt > MAX_ATTEMPTS:
                 raise e
-            sleeptime = pow(2, attempt + 1)
-            print_err("Bad Gateway. Sleeping for {sleeptime}s.")
-            time.sleep(sleeptime)
-            return await generate_chat_response(messages, model, attempt)
-        else:
-            raise e
+            sleeptime = retry_after(e) or pow(2, attempt + 1)
+            if isinstance(e, error.RateLimitError):
+                # Everyone backs off together instead of hammering the API
+                print_err(f"Rate limited, pausing all requests for {sleeptime}s")
+                start_cooldown(sleeptime)
+            else:
+                print_err(f"{e.__class__.__name__}, sleeping for {sleeptime}s")
+                await asyncio.sleep(sleeptime)
+    accounting.record(response.model, response.usage, template_name(messages))
+    if response_cache is not None and (accept is None or accept(get_message_text(response))):
+        response_cache.put(model, messages, temperature, get_message_text(response),
+            {"prompt_tokens": response.usage.prompt_tokens,
+             "completion_tokens": response.usage.completion_tokens,
+             "total_tokens": response.usage.total_tokens},
+            get_total_cost([response]))
+    return response
 
 
 def get_message_text(response):
@@ -103,31 +559,14 @@ def get_total_tokens(responses):
 
 
 def get_total_cost(responses):
-    input_costs = {
-        "gpt-4-0613": 0.03 / 1000,
-        "gpt-4-1106-preview": 0.01 / 1000,
-        "gpt-3.5-turbo-0613": 0.0015 / 1000,
-        "gpt-3.5-turbo-0125": 0.0005 / 1000,
-        "gpt-3.5-turbo-16k-0613": 0.003 / 1000,
-    }
-    output_costs = {
-        "gpt-4-0613": 0.06 / 1000,
-        "gpt-4-1106-preview": 0.03 / 1000,
-        "gpt-3.5-turbo-0613": 0.002 / 1000,
-        "gpt-3.5-turbo-0125": 0.0015 / 1000,
-        "gpt-3.5-turbo-16k-0613": 0.004 / 1000,
-    }
-    # check if models are present
+    # cache hits didn't cost anything
+    responses = [r for r in responses if not getattr(r, "cached", False)]
+    total = 0
     for r in responses:
-        if r.model not in input_costs:
-            print_err(f"{r.model} not found in input costs! update please")
+        cost = accounting.prices.cost(r.model, r.usage.prompt_tokens, r.usage.completion_tokens)
+        # check if models are present
+        if cost is None:
+            print_err(f"{r.model} not found in price table! update please")
             return -1
-
-    return sum(
-        [
-            r.usage.prompt_tokens * input_costs[r.model]
-            + r.usage.completion_tokens * output_costs[r.model]
-            for r in responses
-        ]
-    )
-
+        total += cost
+    return total
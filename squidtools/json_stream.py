@@ -0,0 +1,204 @@
+"""
+Incremental JSON validation for streamed completions.
+
+JSONPrefixValidator is fed a completion chunk by chunk and raises StreamAbort
+as soon as the text so far can't be the start of the JSON we asked for:
+prose before the opening brace, a syntax error, or (with required_keys) a
+top-level object that closes without them. gpt_utils_async uses it to stop
+streaming a reply that's going to fail json_prompt's checks anyway.
+
+    validator = JSONPrefixValidator(required_keys=["name", "year"])
+    validator.feed('```json\n{"name": "x", ')
+    validator.feed('"year"')  # fine so far
+    validator.feed(": 1}")
+    validator.done  # True
+"""
+
+WHITESPACE = " \t\n\r"
+LITERALS = ("true", "false", "null")
+NUMBER_CHARS = set("0123456789+-.eE")
+FENCE = "```"
+
+
+class StreamAbort(Exception):
+    """
+    Raised when a streamed reply can't become valid JSON
+    text is what had arrived so far, response (filled in by
+    generate_chat_response) has the estimated usage of the aborted call
+    """
+
+    def __init__(self, reason, text=""):
+        super().__init__(reason)
+        self.reason = reason
+        self.text = text
+        self.response = None
+
+
+class JSONPrefixValidator:
+    """
+    required_keys: top-level keys the object has to contain
+    ordered: also abort when a required key shows up before an earlier
+    required key, for prompts that spell out the key order
+    """
+
+    def __init__(self, required_keys=None, ordered=False):
+        self.required_keys = list(required_keys or [])
+        self.ordered = ordered
+        self.text = ""
+        self.done = False
+        self.keys = []
+        self._lead = ""
+        self._started = False
+        self._stack = []
+        self._state = "value"
+        self._string = []
+        self._is_key = False
+        self._escape = False
+        self._literal = ""
+
+    def _abort(self, reason):
+        raise StreamAbort(reason, self.text)
+
+    def feed(self, chunk):
+        self.text += chunk
+        if not self._started:
+            chunk = self._strip_lead(chunk)
+            if chunk is None:
+                return
+        for c in chunk:
+            if self.done:
+                # Ignore the closing fence or anything else after the JSON
+                return
+            self._char(c)
+
+    def _strip_lead(self, chunk):
+        # Whitespace and a markdown fence are allowed before the JSON, same
+        # as parse_json strips them
+        self._lead += chunk
+        lead = self._lead.lstrip(WHITESPACE)
+        if lead.startswith(FENCE):
+            lead = lead[len(FENCE):]
+            if len(lead) < 4 and "json".startswith(lead):
+                return None
+            if lead.startswith("json"):
+                lead = lead[4:]
+            lead = lead.lstrip(WHITESPACE)
+        elif FENCE.startswith(lead):
+            return None
+        if not lead:
+            return None
+        if lead[0] not in "{[":
+            self._abort(f"text before JSON: {lead[:40]!r}")
+        self._started = True
+        return lead
+
+    def _char(self, c):
+        state = self._state
+        if state == "string":
+            self._string_char(c)
+        elif state == "literal":
+            if c in NUMBER_CHARS or c.isalpha():
+                self._literal += c
+                self._check_literal(partial=True)
+            else:
+                self._check_literal(partial=False)
+                self._state = "after_value"
+                self._char(c)
+        elif c in WHITESPACE:
+            return
+        elif state in ("value", "value_or_end"):
+            if c == "]" and state == "value_or_end":
+                self._close("[")
+            else:
+                self._value(c)
+        elif state in ("key", "key_or_end"):
+            if c == "}" and state == "key_or_end":
+                self._close("{")
+            elif c == '"':
+                self._start_string(is_key=True)
+            else:
+                self._abort(f"expected a key, got {c!r}")
+        elif state == "colon":
+            if c != ":":
+                self._abort(f"expected ':', got {c!r}")
+            self._state = "value"
+        elif state == "after_value":
+            top = self._stack[-1]
+            if c == ",":
+                self._state = "key" if top == "{" else "value"
+            elif c == "}" and top == "{":
+                self._close("{")
+            elif c == "]" and top == "[":
+                self._close("[")
+            else:
+                self._abort(f"unexpected {c!r} after value")
+
+    def _value(self, c):
+        if c == "{":
+            self._stack.append("{")
+            self._state = "key_or_end"
+        elif c == "[":
+            self._stack.append("[")
+            self._state = "value_or_end"
+        elif c == '"':
+            self._start_string(is_key=False)
+        elif c in NUMBER_CHARS or c in "tfn":
+            self._literal = c
+            self._state = "literal"
+            self._check_literal(partial=True)
+        else:
+            self._abort(f"expected a value, got {c!r}")
+
+    def _check_literal(self, partial):
+        literal = self._literal
+        if literal[0] in "tfn":
+            ok = any(word.startswith(literal) if partial else word == literal for word in LITERALS)
+        else:
+            ok = all(c in NUMBER_CHARS for c in literal)
+            if ok and not partial:
+                try:
+                    float(literal)
+                except ValueError:
+                    ok = False
+        if not ok:
+            self._abort(f"invalid literal {literal!r}")
+
+    def _start_string(self, is_key):
+        self._state = "string"
+        self._is_key = is_key
+        self._string = []
+
+    def _string_char(self, c):
+        if self._escape:
+            self._escape = False
+        elif c == "\\":
+            self._escape = True
+        elif c == '"':
+            if self._is_key:
+                self._key("".join(self._string))
+                self._state = "colon"
+            else:
+                self._state = "after_value"
+            return
+        if self._is_key:
+            self._string.append(c)
+
+    def _key(self, key):
+        if len(self._stack) != 1:
+            return
+        self.keys.append(key)
+        if self.ordered and key in self.required_keys:
+            earlier = self.required_keys[: self.required_keys.index(key)]
+            skipped = [k for k in earlier if k not in self.keys]
+            if skipped:
+                self._abort(f"required keys skipped: {skipped}")
+
+    def _close(self, bracket):
+        self._stack.pop()
+        if not self._stack:
+            if bracket == "{":
+                missing = [k for k in self.required_keys if k not in self.keys]
+                if missing:
+                    self._abort(f"required keys missing: {missing}")
+            self.done = True
+        self._state = "after_value"
@@ -0,0 +1,172 @@
+import os
+import json
+import time
+import random
+from collections import Counter
+
+"""
+Throughput and latency metrics for robust_task runs.
+
+Pass a RunMetrics to any of the robust_task runners to collect items/sec,
+per-item latency percentiles, error counts by exception class, in-flight
+concurrency and an ETA:
+
+    metrics = RunMetrics(path="run.prom", interval=10, callback=print)
+    async_robust_task(objs, task, metrics=metrics)
+    metrics.snapshot()
+
+Every interval seconds the snapshot is passed to callback and written to
+path, as Prometheus textfile format if path ends in .prom, JSON otherwise.
+"""
+
+QUANTILES = (0.5, 0.9, 0.99)
+
+
+class RunMetrics:
+    """
+    total: number of inputs, filled in by the runner if not given
+    callback: called with snapshot() every interval seconds and at the end
+    path: file the snapshot is written to every interval seconds
+    reservoir: number of latencies sampled for the percentiles
+    """
+
+    def __init__(self, total=None, callback=None, path=None, interval=10, reservoir=10000):
+        self.total = total
+        self.callback = callback
+        self.path = path
+        self.interval = interval
+        self.reservoir = reservoir
+        self.already_done = 0
+        self.succeeded = 0
+        self.failed = 0
+        self.timeouts = 0
+        self.errors = Counter()
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.latencies = []
+        self.latency_count = 0
+        self.latency_sum = 0.0
+        self.latency_max = 0.0
+        self.started = time.monotonic()
+        self._last_report = self.started
+        self._begun = False
+
+    def begin(self, total=None, already_done=0):
+        # Retry passes call this again, keep counting from the first call
+        if self._begun:
+            return
+        self._begun = True
+        self.total = self.total if self.total is not None else total
+        self.already_done = already_done
+        self.started = self._last_report = time.monotonic()
+
+    def item_started(self):
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+
+    def item_finished(self, latency, error=None):
+        self.in_flight = max(0, self.in_flight - 1)
+        self._record_latency(latency)
+        if error is None:
+            self.succeeded += 1
+        else:
+            self.failed += 1
+            self.errors[error.__class__.__name__] += 1
+            if isinstance(error, TimeoutError):
+                self.timeouts += 1
+        if time.monotonic() - self._last_report >= self.interval:
+            self.report()
+
+    def _record_latency(self, latency):
+        # Reservoir sampling keeps the percentiles cheap on long runs
+        self.latency_count += 1
+        self.latency_sum += latency
+        self.latency_max = max(self.latency_max, latency)
+        if len(self.latencies) < self.reservoir:
+            self.latencies.append(latency)
+        else:
+            i = random.randrange(self.latency_count)
+            if i < self.reservoir:
+                self.latencies[i] = latency
+
+    def percentiles(self):
+        if not self.latencies:
+            return {q: None for q in QUANTILES}
+        ordered = sorted(self.latencies)
+        return {q: ordered[min(len(ordered) - 1, int(q * len(ordered)))] for q in QUANTILES}
+
+    def snapshot(self):
+        elapsed = time.monotonic() - self.started
+        finished = self.succeeded + self.failed
+        rate = self.succeeded / elapsed if elapsed > 0 else 0.0
+        eta = None
+        if self.total is not None and rate > 0:
+            remaining = max(0, self.total - self.already_done - self.succeeded)
+            eta = remaining / rate
+        return {
+            "elapsed": elapsed,
+            "total": self.total,
+            "already_done": self.already_done,
+            "succeeded": self.succeeded,
+            "failed": self.failed,
+            "timeouts": self.timeouts,
+            "errors": dict(self.errors),
+            "in_flight": self.in_flight,
+            "max_in_flight": self.max_in_flight,
+            "items_per_sec": rate,
+            "attempts_per_sec": finished / elapsed if elapsed > 0 else 0.0,
+            "latency": {
+                "mean": self.latency_sum / self.latency_count if self.latency_count else None,
+                "max": self.latency_max if self.latency_count else None,
+                **{f"p{int(q * 100)}": v for q, v in self.percentiles().items()},
+            },
+            "eta": eta,
+        }
+
+    def to_prometheus(self, snapshot=None):
+        s = snapshot or self.snapshot()
+        lines = [
+            "# TYPE robust_task_items_total counter",
+            f'robust_task_items_total{{status="succeeded"}} {s["succeeded"]}',
+            f'robust_task_items_total{{status="failed"}} {s["failed"]}',
+            "# TYPE robust_task_timeouts_total counter",
+            f"robust_task_timeouts_total {s['timeouts']}",
+            "# TYPE robust_task_errors_total counter",
+        ]
+        for name, count in s["errors"].items():
+            lines.append(f'robust_task_errors_total{{exception="{name}"}} {count}')
+        lines += [
+            "# TYPE robust_task_in_flight gauge",
+            f"robust_task_in_flight {s['in_flight']}",
+            "# TYPE robust_task_items_per_second gauge",
+            f"robust_task_items_per_second {s['items_per_sec']}",
+            "# TYPE robust_task_latency_seconds summary",
+        ]
+        for q in QUANTILES:
+            value = s["latency"][f"p{int(q * 100)}"]
+            if value is not None:
+                lines.append(f'robust_task_latency_seconds{{quantile="{q}"}} {value}')
+        lines += [
+            f"robust_task_latency_seconds_sum {self.latency_sum}",
+            f"robust_task_latency_seconds_count {self.latency_count}",
+        ]
+        if s["eta"] is not None:
+            lines += ["# TYPE robust_task_eta_seconds gauge", f"robust_task_eta_seconds {s['eta']}"]
+        return "\n".join(lines) + "\n"
+
+    def report(self):
+        self._last_report = time.monotonic()
+        snapshot = self.snapshot()
+        if self.path:
+            if self.path.endswith(".prom"):
+                content = self.to_prometheus(snapshot)
+            else:
+                content = json.dumps(snapshot, indent=2)
+            # Write then rename so scrapers never see a half-written file
+            tmp = self.path + ".tmp"
+            with open(tmp, "wt") as f:
+                f.write(content)
+            os.replace(tmp, self.path)
+        if self.callback:
+            self.callback(snapshot)
+        return snapshot
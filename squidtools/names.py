@@ -1,23 +1,39 @@
 # Generic library for
-import spacy
-from collections import Counter
-import en_core_web_sm
+import heapq
+import functools
+from collections import Counter, defaultdict, namedtuple, OrderedDict
 import string
 import Levenshtein
+from .util import gen_batches, lazy
 
 
-nlp = en_core_web_sm.load()
+# The spaCy model takes seconds to load, so it's loaded on first use
+@lazy
+def get_nlp():
+    import en_core_web_sm
+    return en_core_web_sm.load()
+
+def __getattr__(name):
+    # names.nlp still works
+    if name == "nlp":
+        return get_nlp()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+PUNCTUATION = str.maketrans('', '', string.punctuation)
+SUFFIXES = frozenset(["jr", "sr", "i", "ii", "iii", "iv", "v"])
+# Bylines repeat a lot, so cleaning and parsing are cached by raw string
+CACHE_SIZE = 100_000
 
 # Remove spaces and punctuation 
+@functools.lru_cache(maxsize=CACHE_SIZE)
 def clean(name, remove_punct=True):
     n = name.lower().strip()
     if remove_punct:
-        return n.translate(str.maketrans('', '', string.punctuation)).strip()
+        return n.translate(PUNCTUATION).strip()
     else:
         return n
 
 def isSuffix(suffix):
-    SUFFIXES = ["jr", "sr", "i", "ii", "iii", "iv", "v"]
     return clean(suffix) in SUFFIXES
 
 def isInitial(init):
@@ -113,16 +129,36 @@ def parseRawName(namestr):
         'suffix': suffix
     }
 
+class ParsedName(namedtuple('ParsedName', ['firstname', 'middleInitial', 'lastname', 'suffix'])):
+    # Can be read like the dicts parseName returns, parsed['lastname']
+    __slots__ = ()
+
+    def __getitem__(self, key):
+        if isinstance(key, str):
+            return getattr(self, key)
+        return super().__getitem__(key)
+
+    def to_dict(self):
+        return dict(self._asdict())
+
+@functools.lru_cache(maxsize=CACHE_SIZE)
+def parseNameCached(name):
+    # Shared between callers, so it's an (immutable) ParsedName
+    parsed = parseNormalizedName(name) if isNormalizedName(name) else parseRawName(name)
+    return None if parsed is None else ParsedName(**parsed)
+
 def parseName(name):
-    if isNormalizedName(name):
-        return parseNormalizedName(name)
-    else:
-        return parseRawName(name)
+    parsed = parseNameCached(name)
+    return None if parsed is None else parsed.to_dict()
+
 
+@functools.lru_cache(maxsize=CACHE_SIZE)
+def namePieces(name):
+    return frozenset(clean(name).split(" "))
 
 def parseAndCompareNames(name1, name2):
-    no1 = parseName(name1)
-    no2 = parseName(name2)
+    no1 = parseNameCached(name1)
+    no2 = parseNameCached(name2)
     if no1 is None or no2 is None:
         return None
 
@@ -140,9 +176,50 @@ def parseAndCompareNames(name1, name2):
 
 def byline(byline):
     # Given a byline, extract the name string
-    ents = [x.text for x in nlp(byline).ents]
+    ents = [x.text for x in get_nlp()(byline).ents]
     return ents
 
+# Pipeline components NER doesn't need
+NER_UNUSED = ["tagger", "parser", "senter", "attribute_ruler", "lemmatizer"]
+
+def nerDisabled(nlp):
+    disable = [name for name in NER_UNUSED if name in nlp.pipe_names]
+    # The shared tok2vec only feeds the components listening to it; in the
+    # en_core_web 3.x models that's tagger and parser, ner has its own
+    if "tok2vec" in nlp.pipe_names:
+        listening = getattr(nlp.get_pipe("tok2vec"), "listening_components", [])
+        if all(name in disable for name in listening):
+            disable.append("tok2vec")
+    return disable
+
+def bylines(texts, batch_size=256, n_process=1, cache=True, cache_size=100_000, chunk_size=None):
+    """
+    Names (PERSON entities) in each of texts, yielded in order as lists
+    Runs nlp.pipe with everything but NER disabled, n_process processes,
+    over chunks of chunk_size texts (default 10000 per process). With
+    cache, the last cache_size distinct bylines are remembered and not
+    run through the model again.
+    """
+    nlp = get_nlp()
+    disable = nerDisabled(nlp)
+    chunk_size = chunk_size or 10000 * n_process
+    seen = OrderedDict()
+    for chunk in gen_batches(texts, chunk_size):
+        todo = list(dict.fromkeys(t for t in chunk if t not in seen))
+        docs = nlp.pipe(todo, batch_size=batch_size, n_process=n_process, disable=disable)
+        found = {text: [e.text for e in doc.ents if e.label_ == "PERSON"] for text, doc in zip(todo, docs)}
+        for text in chunk:
+            if text in found:
+                names = found[text]
+            else:
+                names = seen[text]
+                seen.move_to_end(text)
+            yield list(names)
+        if cache:
+            seen.update(found)
+            while len(seen) > cache_size:
+                seen.popitem(last=False)
+
 # Generate a simple match score for name matches
 def simpleMatchScore(name1, name2):
     if name1 == name2:
@@ -152,8 +229,8 @@ def simpleMatchScore(name1, name2):
         # Almost exact match
         return 0.99
 
-    pieces1 = set(clean(name1).split(" "))
-    pieces2 = set(clean(name2).split(" "))
+    pieces1 = namePieces(name1)
+    pieces2 = namePieces(name2)
 
     # One name is a strict subset of another name
     # without considering order
@@ -168,4 +245,261 @@ def simpleMatchScore(name1, name2):
         return pcresult['lastname'] * 0.5 + pcresult['firstname'] * 0.3 + pcresult['middleInitial'] * 0.1
     
     return len(common) / ((max(len(pieces1), len(pieces2))) + 0.1)
-    
\ No newline at end of file
+    
+
+
+# Shorter words that differ by a changed letter are usually different names
+# (Mark / Mary, Walker / Walter), not typos
+TYPO_LENGTH = 7
+
+def isTypo(word1, word2, max_edits=1):
+    # Same first letter, within max_edits, and either a dropped / added
+    # letter (Walkr) or a word long enough (Smithsen)
+    word1, word2 = clean(word1), clean(word2)
+    if not word1 or word1[0] != word2[:1]:
+        return False
+    if Levenshtein.distance(word1, word2) > max_edits:
+        return False
+    shorter = min(len(word1), len(word2))
+    return shorter >= TYPO_LENGTH or (len(word1) != len(word2) and shorter >= 4)
+
+def typoMatchScore(name1, name2, max_edits=1):
+    """
+    simpleMatchScore, except that a first or last name (not both) that
+    isTypo of the other one counts as a match, eg "James Walkr" and
+    "Walker, James" score 0.82
+    """
+    score = simpleMatchScore(name1, name2)
+    no1 = parseNameCached(name1)
+    no2 = parseNameCached(name2)
+    if no1 is None or no2 is None:
+        return score
+    parts = {}
+    typos = 0
+    for part in ('firstname', 'middleInitial', 'lastname'):
+        if no1[part] is None or no2[part] is None:
+            parts[part] = 0.2
+        elif clean(no1[part]) == clean(no2[part]):
+            parts[part] = 1
+        elif part != 'middleInitial' and isTypo(no1[part], no2[part], max_edits):
+            parts[part] = 1
+            typos += 1
+        else:
+            parts[part] = 0
+    if typos != 1:
+        return score
+    return max(score, parts['lastname'] * 0.5 + parts['firstname'] * 0.3 + parts['middleInitial'] * 0.1)
+
+
+SOUNDEX_CODES = {c: str(d) for d, letters in enumerate(
+    ["aeiouyhw", "bfpv", "cgjkqsxz", "dt", "l", "mn", "r"]) for c in letters}
+
+def soundex(word):
+    # American soundex, eg "Robert" and "Rupert" => R163
+    letters = [c for c in clean(word) if c in SOUNDEX_CODES]
+    if not letters:
+        return ""
+    code = letters[0].upper()
+    last = SOUNDEX_CODES[letters[0]]
+    for c in letters[1:]:
+        digit = SOUNDEX_CODES[c]
+        if digit != "0" and digit != last:
+            code += digit
+        # h and w don't separate letters with the same code, vowels do
+        if c not in "hw":
+            last = digit
+    return (code + "000")[:4]
+
+def lastName(name):
+    # Best guess at the last name, even when parseName gives up
+    parsed = parseNameCached(name)
+    if parsed and parsed['lastname']:
+        return clean(parsed['lastname'])
+    tokens = [t for t in clean(unnormalize(name)).split(' ') if t and not isSuffix(t)]
+    return tokens[-1] if tokens else None
+
+
+class NameIndex:
+    """
+    Reference names indexed for matching many names against them
+    names: list of names, or dict of id -> name
+    Only reference names that share a cleaned word (2+ letters) with the
+    query, or the soundex code of its last name if phonetic, are scored with
+    simpleMatchScore. Pairs that share no word score 0.32 at most (matching
+    first initials), so everything scoring above that is found.
+    max_block: skip words shared by more reference names than this (eg
+    "john"), trading recall for speed on big lists
+    """
+
+    def __init__(self, names, phonetic=True, max_block=None):
+        self.names = names if isinstance(names, dict) else dict(enumerate(names))
+        self.phonetic = phonetic
+        self.max_block = max_block
+        self.blocks = defaultdict(list)
+        for id, name in self.names.items():
+            for key in self.keys(name):
+                self.blocks[key].append(id)
+
+    def keys(self, name):
+        keys = {t for t in clean(unnormalize(name)).split(' ') if len(t) > 1}
+        if self.phonetic:
+            last = lastName(name)
+            if last:
+                # prefixed so codes can't collide with words
+                keys.add('#' + soundex(last))
+        return keys
+
+    def candidates(self, name):
+        ids = set()
+        for key in self.keys(name):
+            block = self.blocks.get(key, ())
+            if self.max_block is not None and len(block) > self.max_block:
+                continue
+            ids.update(block)
+        return ids
+
+    def match(self, name, k=5, min_score=0):
+        """Top k (id, reference name, simpleMatchScore) for name, best first"""
+        scored = []
+        for id in self.candidates(name):
+            score = simpleMatchScore(name, self.names[id])
+            if score >= min_score:
+                scored.append((score, id))
+        top = heapq.nlargest(k, scored, key=lambda pair: pair[0])
+        return [(id, self.names[id], score) for score, id in top]
+
+    def match_many(self, names, k=5, min_score=0):
+        """match for every name, repeated names are only looked up once"""
+        seen = {}
+        results = []
+        for name in names:
+            if name not in seen:
+                seen[name] = self.match(name, k, min_score)
+            results.append(seen[name])
+        return results
+
+
+def nameKey(name):
+    # Words of 2+ letters, sorted, without suffixes: "Walker, James",
+    # "JAMES A. WALKER" and "James Walker Jr." are all "james walker"
+    words = [t for t in clean(unnormalize(name)).split(' ') if len(t) > 1 and not isSuffix(t)]
+    return ' '.join(sorted(words))
+
+def deletes(word, max_edits=1):
+    # Every string left after deleting up to max_edits characters (SymSpell)
+    found = {word}
+    frontier = {word}
+    for _ in range(max_edits):
+        frontier = {w[:i] + w[i + 1:] for w in frontier for i in range(len(w))} - found
+        found |= frontier
+    return found
+
+
+class UnionFind:
+    # Disjoint sets over 0..n-1, with path halving and union by size
+    def __init__(self, n):
+        self.parent = list(range(n))
+        self.size = [1] * n
+
+    def find(self, i):
+        parent = self.parent
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    def union(self, i, j):
+        i, j = self.find(i), self.find(j)
+        if i == j:
+            return i
+        if self.size[i] < self.size[j]:
+            i, j = j, i
+        self.parent[j] = i
+        self.size[i] += self.size[j]
+        return i
+
+
+def clusterNames(names, threshold=0.81, max_edits=1, min_fuzzy_length=8):
+    """
+    Group author strings that are probably the same person, without
+    comparing all pairs. Returns (assignments, clusters): name -> cluster id,
+    and cluster id -> distinct names, canonical (most frequent) name first.
+    Cluster ids go from 0, biggest cluster (by occurrences) first.
+
+    Names are only compared when they clean to the same string, share a
+    nameKey, or (for keys of min_fuzzy_length+ characters) have keys within
+    max_edits edits of each other, found through a deletion index;
+    max_edits=0 turns the last off. Compared names are merged when
+    simpleMatchScore >= threshold (typoMatchScore for near-identical keys,
+    so "James Walkr" joins "James Walker" but "James Walter" doesn't): the
+    default merges "Walker, James" with "James A. Walker" (0.82) but doesn't
+    merge "James A. Walker" with "James B. Walker" (0.8) directly. Merging is
+    transitive though, so both end up in one cluster if the list also has
+    "James Walker".
+    """
+    counts = Counter(name for name in names if name)
+    distinct = list(counts)
+    sets = UnionFind(len(distinct))
+
+    # Case and punctuation variants, then names sharing a key
+    by_clean = {}
+    for i, name in enumerate(distinct):
+        cleaned = clean(name)
+        if cleaned in by_clean:
+            sets.union(by_clean[cleaned], i)
+        else:
+            by_clean[cleaned] = i
+    by_key = defaultdict(list)
+    for i in by_clean.values():
+        by_key[nameKey(distinct[i])].append(i)
+    heads = {}
+    for key, ids in by_key.items():
+        # Each name is scored against one name per group found so far,
+        # usually one or two (different middle initials)
+        heads[key] = []
+        for i in ids:
+            matched = False
+            for head in heads[key]:
+                if simpleMatchScore(distinct[head], distinct[i]) >= threshold:
+                    sets.union(head, i)
+                    matched = True
+            if not matched:
+                heads[key].append(i)
+
+    def merge(heads1, heads2):
+        for i in heads1:
+            for j in heads2:
+                if typoMatchScore(distinct[i], distinct[j], max_edits) >= threshold:
+                    sets.union(i, j)
+
+    # Near-identical keys: keys within max_edits share a deletion
+    if max_edits > 0:
+        keys = [key for key in by_key if len(key) >= min_fuzzy_length]
+        index = defaultdict(list)
+        for k, key in enumerate(keys):
+            for variant in deletes(key, max_edits):
+                index[variant].append(k)
+        checked = set()
+        for block in index.values():
+            for a in range(len(block)):
+                for b in range(a + 1, len(block)):
+                    pair = (block[a], block[b])
+                    if pair in checked:
+                        continue
+                    checked.add(pair)
+                    key1, key2 = keys[pair[0]], keys[pair[1]]
+                    if Levenshtein.distance(key1, key2) <= max_edits:
+                        merge(heads[key1], heads[key2])
+
+    members = defaultdict(list)
+    for i in range(len(distinct)):
+        members[sets.find(i)].append(distinct[i])
+    groups = [sorted(group, key=lambda name: (-counts[name], -len(name), name)) for group in members.values()]
+    groups.sort(key=lambda group: (-sum(counts[name] for name in group), group[0]))
+    assignments = {}
+    clusters = {}
+    for id, group in enumerate(groups):
+        clusters[id] = group
+        for name in group:
+            assignments[name] = id
+    return assignments, clusters
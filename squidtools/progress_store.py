@@ -0,0 +1,433 @@
+import os
+import json
+import time
+import sqlite3
+from collections.abc import Mapping
+
+from .util import print_err
+
+"""
+Progress stores for robust_task.
+
+A progress store maps a primary key (the '_pkey' of each record) to the JSON
+result that was saved for it. Stores answer "is this key done?" from a key
+index without loading any values, and only read a record off disk when it
+is asked for.
+
+JSONLProgress is the default and keeps the original lines-of-json format,
+including legacy files that index records by 'filename'. SQLiteProgress
+keeps everything in a single sqlite database instead.
+
+Use open_progress to pick a store from the progress filename.
+
+Writes can be grouped: with flush_every=N and/or flush_ms=T a store keeps its
+file open and only writes out (or commits) every N records or T milliseconds,
+so at most one flush window of results is lost on a hard crash. put() only
+checks flush_ms when a record comes in, so while waiting on slow items call
+flush_if_due() now and then; the robust_task runners do, and call flush()
+when done, even on exceptions and KeyboardInterrupt.
+"""
+
+PKEY = "_pkey"
+LEGACY_PKEY = "filename"
+
+INDEX_SUFFIX = ".idx"
+SQLITE_EXTENSIONS = (".db", ".sqlite", ".sqlite3")
+
+
+def record_key(record):
+    # Legacy code, some progress files index by filename
+    return record.get(PKEY, record.get(LEGACY_PKEY))
+
+
+class JSONLProgress(Mapping):
+    """
+    Append-only JSONL progress log with an on-disk key index.
+
+    The index lives next to the log (progress.json.idx) and holds one
+    [key, offset, length] line per record. On open only the index is read,
+    plus whatever was appended to the log since the index was last written,
+    so restarts don't parse every record. An index that doesn't match its log
+    (eg left behind when the log was replaced) is rebuilt from the log.
+    Later records for a key overwrite earlier ones; compact() rewrites the
+    log without the overwritten lines.
+
+    fsync=True also syncs the log to disk on every flush.
+    readonly=True never touches the files, for reading a log that another
+    process is writing to. refresh() picks up records appended since open.
+    """
+
+    def __init__(self, pname, flush_every=1, flush_ms=None, fsync=False, readonly=False):
+        self.pname = pname
+        self.index_name = pname + INDEX_SUFFIX
+        self.readonly = readonly
+        self.flush_every = flush_every
+        self.flush_ms = flush_ms
+        self.fsync = fsync
+        # lines and index entries waiting for the next flush
+        self._pending = []
+        self._pending_index = []
+        self._last_flush = time.monotonic()
+        self._writer = None
+        self._index_writer = None
+        # key -> (offset, length) of the latest record in the log
+        self._index = {}
+        # number of bytes of the log covered by the index
+        self._size = 0
+        # number of records in the log that were overwritten by a later one
+        self.stale = 0
+        self._reader = None
+        self._load_index()
+        # end of the log including pending lines, and end of what was written
+        self._end = self._size
+        self._flushed_end = self._size
+
+    def _load_index(self):
+        if not os.path.exists(self.pname):
+            if os.path.exists(self.index_name) and not self.readonly:
+                os.remove(self.index_name)
+            return
+        if os.path.exists(self.index_name):
+            try:
+                with open(self.index_name, "rt") as f:
+                    for line in f:
+                        key, offset, length = json.loads(line)
+                        self._add(key, offset, length)
+            except ValueError:
+                # Torn write from a crash, start over from the log
+                self._reset_index()
+            if not self._index_matches_log():
+                # The log was rewritten, truncated or replaced behind our back
+                print_err(f"{self.index_name} doesn't match {self.pname}, rebuilding it")
+                self._reset_index()
+        # Catch up on records appended since the index was last written
+        self._scan()
+
+    def _index_matches_log(self):
+        # Nothing ties the index to one particular log (eg the log was moved
+        # away and another one put in its place), so check that the first and
+        # last records it points at are whole lines with the indexed keys
+        if self._size > os.path.getsize(self.pname):
+            return False
+        if not self._index:
+            return True
+        ends = [
+            min(self._index.items(), key=lambda item: item[1][0]),
+            max(self._index.items(), key=lambda item: item[1][0]),
+        ]
+        try:
+            with open(self.pname, "rb") as f:
+                for key, (offset, length) in ends:
+                    if offset > 0:
+                        f.seek(offset - 1)
+                        if f.read(1) != b"\n":
+                            return False
+                    f.seek(offset)
+                    line = f.read(length)
+                    if not line.endswith(b"\n") or record_key(json.loads(line)) != key:
+                        return False
+        except (ValueError, AttributeError):
+            # Not JSON, or not a JSON object
+            return False
+        return True
+
+    def _reset_index(self):
+        self._index = {}
+        self._size = 0
+        self.stale = 0
+        if not self.readonly:
+            with open(self.index_name, "wt"):
+                pass
+
+    def _add(self, key, offset, length):
+        if key in self._index:
+            self.stale += 1
+        self._index[key] = (offset, length)
+        self._size = max(self._size, offset + length)
+
+    def _scan(self):
+        entries = []
+        with open(self.pname, "rb") as f:
+            f.seek(self._size)
+            offset = self._size
+            for line in f:
+                if not line.endswith(b"\n"):
+                    if self.readonly:
+                        # Possibly still being written
+                        break
+                    # Partial last line from an interrupted write, drop it
+                    # so that new records don't get appended onto it
+                    print_err(f"{self.pname}: dropping partial record at byte {offset}")
+                    f.close()
+                    os.truncate(self.pname, offset)
+                    break
+                length = len(line)
+                if line.strip():
+                    pk = record_key(json.loads(line))
+                    if pk is not None:
+                        self._add(pk, offset, length)
+                        entries.append((pk, offset, length))
+                offset += length
+        # Skip blank lines next time around too
+        self._size = max(self._size, offset)
+        if entries and not self.readonly:
+            self._write_index(entries)
+
+    def refresh(self):
+        """Index records appended to the log by another process."""
+        self.flush()
+        if os.path.exists(self.pname):
+            self._scan()
+            self._end = self._flushed_end = self._size
+
+    def _write_index(self, entries):
+        with open(self.index_name, "at") as f:
+            for entry in entries:
+                f.write(json.dumps(entry) + "\n")
+
+    def _read(self, offset, length):
+        if offset + length > self._flushed_end:
+            self.flush()
+        if self._reader is None:
+            self._reader = open(self.pname, "rb")
+        self._reader.seek(offset)
+        return json.loads(self._reader.read(length))
+
+    def __contains__(self, key):
+        return key in self._index
+
+    def __getitem__(self, key):
+        offset, length = self._index[key]
+        return self._read(offset, length)
+
+    def __iter__(self):
+        return iter(self._index)
+
+    def __len__(self):
+        return len(self._index)
+
+    def put(self, key, result: dict):
+        result[PKEY] = key
+        line = (json.dumps(result) + "\n").encode()
+        offset = self._end
+        self._end += len(line)
+        self._add(key, offset, len(line))
+        self._pending.append(line)
+        self._pending_index.append((key, offset, len(line)))
+        if len(self._pending) >= self.flush_every:
+            self.flush()
+        else:
+            self.flush_if_due()
+
+    @property
+    def unflushed(self):
+        """Number of records put since the last flush"""
+        return len(self._pending)
+
+    def flush_if_due(self):
+        """Flush if flush_ms have passed since the last flush, returns whether it did"""
+        if self.flush_ms is None or not self.unflushed:
+            return False
+        if (time.monotonic() - self._last_flush) * 1000 < self.flush_ms:
+            return False
+        self.flush()
+        return True
+
+    def flush(self):
+        self._last_flush = time.monotonic()
+        if not self._pending:
+            return
+        if self._writer is None:
+            self._writer = open(self.pname, "ab")
+            self._index_writer = open(self.index_name, "at")
+        # The log goes first, an index entry pointing past the end of the
+        # log just makes the next open rebuild the index
+        self._writer.write(b"".join(self._pending))
+        self._writer.flush()
+        if self.fsync:
+            os.fsync(self._writer.fileno())
+        self._index_writer.write(
+            "".join(json.dumps(entry) + "\n" for entry in self._pending_index)
+        )
+        self._index_writer.flush()
+        self._flushed_end = self._end
+        self._pending = []
+        self._pending_index = []
+
+    def records(self):
+        """Yield (key, record) pairs, reading the log sequentially."""
+        self.flush()
+        live = {offset: key for key, (offset, _) in self._index.items()}
+        if not live:
+            return
+        with open(self.pname, "rb") as f:
+            offset = 0
+            for line in f:
+                key = live.get(offset)
+                if key is not None:
+                    yield key, json.loads(line)
+                offset += len(line)
+
+    def to_dict(self):
+        return dict(self.records())
+
+    def compact(self):
+        """Rewrite the log keeping only the latest record for each key."""
+        if self.stale == 0:
+            return 0
+        dropped = self.stale
+        tmp_name = self.pname + ".compact"
+        entries = []
+        with open(tmp_name, "wb") as out:
+            for key, record in self.records():
+                line = (json.dumps(record) + "\n").encode()
+                entries.append((key, out.tell(), len(line)))
+                out.write(line)
+        self.close()
+        os.replace(tmp_name, self.pname)
+        self._reset_index()
+        for entry in entries:
+            self._add(*entry)
+        self._write_index(entries)
+        self._end = self._flushed_end = self._size
+        return dropped
+
+    def close(self):
+        self.flush()
+        for f in (self._reader, self._writer, self._index_writer):
+            if f is not None:
+                f.close()
+        self._reader = self._writer = self._index_writer = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class SQLiteProgress(Mapping):
+    """
+    Progress store backed by a sqlite database.
+
+    Keys are stored JSON-encoded so int and str keys round-trip the same way
+    they do through a JSONL log. With flush_every/flush_ms, puts are grouped
+    into one transaction per flush.
+    """
+
+    def __init__(self, pname, flush_every=1, flush_ms=None, readonly=False):
+        self.pname = pname
+        self.flush_every = flush_every
+        self.flush_ms = flush_ms
+        self.readonly = readonly
+        self._pending = 0
+        self._last_flush = time.monotonic()
+        if readonly:
+            self.conn = sqlite3.connect(f"file:{pname}?mode=ro", uri=True)
+        else:
+            self.conn = sqlite3.connect(pname)
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS progress (pkey TEXT PRIMARY KEY, record TEXT NOT NULL)"
+            )
+            self.conn.commit()
+
+    def refresh(self):
+        # Every query already sees the latest committed state
+        pass
+
+    def __contains__(self, key):
+        row = self.conn.execute(
+            "SELECT 1 FROM progress WHERE pkey = ?", (json.dumps(key),)
+        ).fetchone()
+        return row is not None
+
+    def __getitem__(self, key):
+        row = self.conn.execute(
+            "SELECT record FROM progress WHERE pkey = ?", (json.dumps(key),)
+        ).fetchone()
+        if row is None:
+            raise KeyError(key)
+        return json.loads(row[0])
+
+    def __iter__(self):
+        for (pkey,) in self.conn.execute("SELECT pkey FROM progress ORDER BY rowid"):
+            yield json.loads(pkey)
+
+    def __len__(self):
+        return self.conn.execute("SELECT COUNT(*) FROM progress").fetchone()[0]
+
+    def put(self, key, result: dict):
+        result[PKEY] = key
+        self.conn.execute(
+            "INSERT OR REPLACE INTO progress (pkey, record) VALUES (?, ?)",
+            (json.dumps(key), json.dumps(result)),
+        )
+        self._pending += 1
+        if self._pending >= self.flush_every:
+            self.flush()
+        else:
+            self.flush_if_due()
+
+    @property
+    def unflushed(self):
+        """Number of records put since the last commit"""
+        return self._pending
+
+    def flush_if_due(self):
+        """Flush if flush_ms have passed since the last flush, returns whether it did"""
+        if self.flush_ms is None or not self.unflushed:
+            return False
+        if (time.monotonic() - self._last_flush) * 1000 < self.flush_ms:
+            return False
+        self.flush()
+        return True
+
+    def flush(self):
+        self._last_flush = time.monotonic()
+        if self._pending:
+            self.conn.commit()
+            self._pending = 0
+
+    def records(self):
+        rows = self.conn.execute("SELECT pkey, record FROM progress ORDER BY rowid")
+        for pkey, record in rows:
+            yield json.loads(pkey), json.loads(record)
+
+    def to_dict(self):
+        return dict(self.records())
+
+    def import_jsonl(self, jsonl_name):
+        """Copy the records of a (possibly legacy) JSONL progress file into this store."""
+        source = JSONLProgress(jsonl_name)
+        with self.conn:
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO progress (pkey, record) VALUES (?, ?)",
+                ((json.dumps(k), json.dumps(r)) for k, r in source.records()),
+            )
+        source.close()
+
+    def compact(self):
+        # Overwrites happen in place, so compaction just reclaims free pages
+        self.flush()
+        self.conn.execute("VACUUM")
+        return 0
+
+    def close(self):
+        self.flush()
+        self.conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def open_progress(pname, flush_every=1, flush_ms=None, fsync=False, readonly=False):
+    """
+    Open the progress store for pname, choosing the backend by file extension.
+    fsync only applies to JSONL logs, sqlite commits are already synced.
+    """
+    if os.path.splitext(pname)[1] in SQLITE_EXTENSIONS:
+        return SQLiteProgress(pname, flush_every, flush_ms, readonly)
+    return JSONLProgress(pname, flush_every, flush_ms, fsync, readonly)
@@ -99,9 +99,31 @@ def save_txtfiles(records, dir):
     return records
 
 
-def convert_all(dirname, tsvname, txtdir="txt"):
+def cluster_authors(records, **kwargs):
+    """
+    Adds author_cluster (an id shared by records whose authors are probably
+    the same person, None without an author) and author_canonical to each
+    record, using names.clusterNames (kwargs go to it). Returns the clusters.
+    """
+    # Levenshtein is only needed for clustering
+    from . import names
+
+    def author(r):
+        return r.get("author") or r.get("author_normalized")
+
+    assignments, clusters = names.clusterNames((author(r) for r in records), **kwargs)
+    for r in records:
+        id = assignments.get(author(r))
+        r["author_cluster"] = id
+        r["author_canonical"] = None if id is None else clusters[id][0]
+    return clusters
+
+
+def convert_all(dirname, tsvname, txtdir="txt", cluster=False):
     records = []
     for f in os.listdir(dirname):
         records.append(parse_proquest_xml(dirname + "/" + f))
+    if cluster:
+        cluster_authors(records)
     save_txtfiles(records, txtdir)
     util.write_csv(records, tsvname, delimiter="\t")
@@ -1,14 +1,33 @@
-from QualtricsAPI.Setup import Credentials
-from QualtricsAPI.Survey import Responses
 import os
-import wordfreq
+from .util import lazy
 
-Credentials().qualtrics_api_credentials(token=os.environ['QUALTRICS_TOKEN'],data_center=os.environ['QUALTRICS_DC'])
+# QualtricsAPI and its credentials are only set up when first used, so
+# importing this module doesn't need QUALTRICS_TOKEN / QUALTRICS_DC
+@lazy
+def qualtrics_api():
+    from QualtricsAPI.Setup import Credentials
+    from QualtricsAPI.Survey import Responses
+    Credentials().qualtrics_api_credentials(token=os.environ['QUALTRICS_TOKEN'],data_center=os.environ['QUALTRICS_DC'])
+    return Responses
+
+@lazy
+def get_wordfreq():
+    import wordfreq
+    return wordfreq
+
+def __getattr__(name):
+    # qualtrics.Responses / qualtrics.wordfreq still work
+    if name == "Responses":
+        return qualtrics_api()
+    if name == "wordfreq":
+        return get_wordfreq()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
 
 
 def download_survey(sid, dest):
     if os.path.isdir(dest):
         dest = f"{dest}/{sid}"
+    Responses = qualtrics_api()
     responses = Responses().get_survey_responses(survey=sid)
     questions = Responses().get_survey_questions(survey=sid).to_dict('Questions')
     # Automatically create better labels
@@ -0,0 +1,136 @@
+import asyncio
+import time
+
+"""
+Adaptive concurrency control for async_robust_task.
+
+AdaptiveLimiter does AIMD (additive increase, multiplicative decrease) on the
+number of requests in flight: every success grows the limit by about one
+slot per window of requests, and a timeout or rate limit error cuts it by
+a factor. Optionally it also enforces a hard requests-per-second or
+requests-per-minute ceiling with a token bucket.
+
+    limiter = AdaptiveLimiter(start=10, max_concurrency=200, rpm=3000)
+    async_robust_task(objs, task, rate_limiter=limiter)
+    print(limiter.state())
+"""
+
+
+def is_backoff_error(e):
+    # Timeouts and anything that looks like a 429 from openai/httpx/etc
+    if isinstance(e, (asyncio.TimeoutError, TimeoutError)):
+        return True
+    if getattr(e, "status_code", None) == 429:
+        return True
+    name = e.__class__.__name__
+    return "RateLimit" in name or "TooManyRequests" in name
+
+
+class AdaptiveLimiter:
+    """
+    start/min_concurrency/max_concurrency: bounds on the in-flight limit
+    increase: slots added per window of successful requests
+    decrease: factor the limit is multiplied by on a timeout or rate limit
+    target_latency: if set, successes slower than this (seconds) count as
+        a signal to back off too
+    rps/rpm: hard ceiling on request starts per second / minute
+    backoff_on: extra exception classes to treat as rate limit errors
+    """
+
+    def __init__(
+        self,
+        start=10,
+        min_concurrency=1,
+        max_concurrency=100,
+        increase=1,
+        decrease=0.5,
+        target_latency=None,
+        rps=None,
+        rpm=None,
+        backoff_on=(),
+    ):
+        self.limit = float(start)
+        self.min_concurrency = min_concurrency
+        self.max_concurrency = max_concurrency
+        self.increase = increase
+        self.decrease = decrease
+        self.target_latency = target_latency
+        self.backoff_on = tuple(backoff_on)
+        self.rate = rps if rps is not None else (rpm / 60 if rpm is not None else None)
+        # token bucket, allows a burst of up to one second's worth of requests
+        self.capacity = max(1.0, self.rate) if self.rate else None
+        self._tokens = self.capacity
+        self._refilled = time.monotonic()
+
+        self.in_flight = 0
+        self.successes = 0
+        self.errors = 0
+        self.backoffs = 0
+        self.latency = None
+        self._last_decrease = 0
+        self._waiters = []
+
+    @property
+    def concurrency(self):
+        return max(self.min_concurrency, int(self.limit))
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(self.capacity, self._tokens + (now - self._refilled) * self.rate)
+        self._refilled = now
+
+    async def acquire(self):
+        """Wait for a free slot (and a token), returns the start time to pass to release"""
+        while self.in_flight >= self.concurrency:
+            waiter = asyncio.get_running_loop().create_future()
+            self._waiters.append(waiter)
+            await waiter
+        self.in_flight += 1
+        if self.rate:
+            self._refill()
+            while self._tokens < 1:
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+                self._refill()
+            self._tokens -= 1
+        return time.monotonic()
+
+    def release(self, started, error=None):
+        now = time.monotonic()
+        self.in_flight -= 1
+        latency = now - started
+        self.latency = latency if self.latency is None else 0.8 * self.latency + 0.2 * latency
+
+        backoff = error is not None and (
+            is_backoff_error(error) or isinstance(error, self.backoff_on)
+        )
+        slow = error is None and self.target_latency is not None and latency > self.target_latency
+        if error is None:
+            self.successes += 1
+        elif not backoff:
+            self.errors += 1
+
+        if backoff or slow:
+            self.backoffs += 1
+            # Requests that started before the last cut saw the old limit,
+            # only back off once per congestion event
+            if started >= self._last_decrease:
+                self.limit = max(self.min_concurrency, self.limit * self.decrease)
+                self._last_decrease = now
+        elif error is None:
+            self.limit = min(self.max_concurrency, self.limit + self.increase / self.limit)
+
+        waiters, self._waiters = self._waiters, []
+        for waiter in waiters:
+            if not waiter.done():
+                waiter.set_result(None)
+
+    def state(self):
+        return {
+            "limit": self.concurrency,
+            "in_flight": self.in_flight,
+            "successes": self.successes,
+            "errors": self.errors,
+            "backoffs": self.backoffs,
+            "latency": self.latency,
+            "rate": self.rate,
+        }
@@ -5,8 +5,16 @@ import json
 import csv
 import sys
 import time
+import heapq
+import itertools
+from collections.abc import Iterable, Mapping
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from concurrent.futures.process import BrokenProcessPool
 
 from .util import gen_batches, print_err
+from .progress_store import open_progress
+from .sharding import worker_progress_name
+from .failures import FailureLedger, LEDGER_SUFFIX, policy_for
 
 """
 Library / helper functions to manage idempotent execution of flaky tasks.
@@ -15,6 +23,8 @@ Supply robust_task with a list of files that need to be processed and a processi
 that returns a dict (or other JSON serializable) result
 
 Results are stored on disk in the progress capture filename given (or progress.json as default)
+Progress filenames ending in .db/.sqlite are stored in sqlite instead (see progress_store),
+or pass any store object as progress_store
 """
 
 DEFAULT_FILENAME = "progress.json"
@@ -27,17 +37,10 @@ PKEY = "_pkey"
 # This design allows us to easily append new records to the file
 # Note if multiple records use the same pkey, later entries overwrite the older ones
 # This is useful when intentionally overwriting records
+# The key -> offset index is kept on disk by progress_store.JSONLProgress,
+# this reads every record into a dict
 def load_progress(pname):
-    progress = {}
-    if os.path.exists(pname):
-        with open(pname, "rt") as f:
-            for line in f:
-                p = json.loads(line)
-                # Legacy code, some progress files index by filename
-                pk = p.get(PKEY, p.get("filename"))
-                if pk:
-                    progress[pk] = p
-    return progress
+    return open_progress(pname).to_dict()
 
 
 # Save the result to disk
@@ -47,48 +50,359 @@ def save_progress(pname, name: str, result: dict):
         f.write(json.dumps(result) + "\n")
 
 
+# Normalize the inputs into an iterator of (key, value) pairs
+# Lists are keyed by their values, dicts by their keys, and any other iterable
+# (eg a directory walk or a database cursor) can yield either (key, value)
+# tuples or plain strings
+def iter_objs(objs):
+    if isinstance(objs, list):
+        return ((k, k) for k in objs)
+    if isinstance(objs, Mapping):
+        return iter(objs.items())
+    return (o if isinstance(o, tuple) else (o, o) for o in objs)
+
+
+def _count(objs, total):
+    if total is not None:
+        return total
+    try:
+        return len(objs)
+    except TypeError:
+        return None
+
+
+def _open(progress_name, progress_store, worker):
+    if progress_store is not None:
+        if worker is not None:
+            worker.use_progress_name(progress_name)
+        return progress_store
+    if worker is not None:
+        return worker.open_progress(progress_name)
+    return open_progress(progress_name)
+
+
+def _ledger(progress_name, worker):
+    # Workers each keep their own ledger next to their own progress file
+    if worker is not None:
+        progress_name = worker_progress_name(progress_name, worker.worker_id)
+    return FailureLedger(progress_name + LEDGER_SUFFIX)
+
+
+def _flush(progress, worker):
+    progress.flush()
+    # Leases are only marked done once the results are on disk
+    if worker is not None:
+        worker.flushed()
+
+
+def _flush_if_due(progress, worker):
+    # Stores without flush_ms write on every put
+    flush_if_due = getattr(progress, "flush_if_due", None)
+    if flush_if_due is not None and flush_if_due() and worker is not None:
+        worker.flushed()
+
+
+async def _flusher(progress, worker):
+    # Writes out buffered results every flush_ms, even while no item finishes
+    flush_ms = getattr(progress, "flush_ms", None)
+    if not flush_ms:
+        return
+    while True:
+        await asyncio.sleep(flush_ms / 1000)
+        _flush_if_due(progress, worker)
+
+
+async def _with_flusher(progress, worker, coro):
+    flusher = asyncio.ensure_future(_flusher(progress, worker))
+    try:
+        return await coro
+    finally:
+        flusher.cancel()
+
+
+def _retry_delay(retry_policy, e, attempt):
+    policy = policy_for(retry_policy, e)
+    return policy.delay(attempt) if policy else None
+
+
+def _begin_metrics(metrics, progress, n_objs):
+    if metrics is not None:
+        metrics.begin(n_objs, len(progress))
+
+
+def _end_metrics(metrics):
+    if metrics is not None:
+        metrics.report()
+
+
+def _todo(objs, progress, skip_existing, worker=None):
+    # Checked lazily, so items finished earlier in this run are seen too
+    # and workers only claim an item right before processing it
+    return (
+        (k, v)
+        for k, v in iter_objs(objs)
+        if not (skip_existing and k in progress)
+        and (worker is None or worker.claim(k))
+    )
+
+
+def _should_stop(stop):
+    if stop is not None and stop():
+        print_err("robust_task: stop requested, not starting any more items")
+        return True
+    return False
+
+
+def _progress_msg(done, n_objs):
+    if n_objs:
+        return f"{done}/{n_objs} - {int(done / n_objs * 100)}%"
+    return f"{done}"
+
+
+def _results(progress, return_results):
+    return progress.to_dict() if return_results else progress
+
+
 """
-objs: array or dict of strings to process. 
+objs: array or dict of strings to process, or an iterator of (key, value) pairs / strings
     if dict, progress is tracked by the dict keys and the task operates on the dict values
 task: function that processes a string
 progress_name: file that stores progress 
 skip_existing: don't re-process already processed files
+progress_store: store to use instead of opening progress_name (see progress_store)
+    eg open_progress(progress_name, flush_every=1000, flush_ms=500) to group writes
+total: number of inputs, for progress display when objs is an iterator
+return_results: return all results as a dict (default). If False, return the
+    progress store itself, which reads records from disk as they are accessed
+worker: a sharding.Worker, to split the job between several processes or
+    machines running on the same progress_name (see sharding)
+retry_policy: a failures.RetryPolicy, or a dict of exception class/name -> policy.
+    Failed items are retried with backoff while the rest of the run continues
+Failures are recorded in progress_name + ".failures", see retry_failed
+metrics: a metrics.RunMetrics collecting throughput, latency and error counts
+stop: called before starting each item, once it returns True no more items are
+    started (eg stop=accounting.exhausted to stay within a gpt_accounting budget)
 """
 
 
 def robust_task(
-    objs: dict[str, str] | list[str],
+    objs: dict[str, str] | list[str] | Iterable,
     task,
     progress_name=DEFAULT_FILENAME,
     skip_existing=True,
     show_progress=True,
+    progress_store=None,
+    total=None,
+    return_results=True,
+    worker=None,
+    retry_policy=None,
+    metrics=None,
+    stop=None,
 ):
-    progress = load_progress(progress_name)
-    if isinstance(objs, list):
-        objs = {k: k for k in objs}
-
-    n_objs = len(objs.keys())
-    names = (
-        (k for k in objs.keys() if k not in progress) if skip_existing else objs.keys()
-    )
+    progress = _open(progress_name, progress_store, worker)
+    ledger = _ledger(progress_name, worker)
+    n_objs = _count(objs, total)
+    _begin_metrics(metrics, progress, n_objs)
+    stopped = False
+    # heap of (due time, seq, name, value, attempt) waiting to be retried
+    retries = []
+    seq = itertools.count()
 
-    for i, name in enumerate(names):
-        if skip_existing and name in progress:
-            continue
+    def run(name, value, attempt):
+        if metrics:
+            metrics.item_started()
+            started = time.monotonic()
         try:
-            results = task(objs[name])
-            save_progress(progress_name, name, results)
+            results = task(value)
+            progress.put(name, results)
         except Exception as e:
+            if metrics:
+                metrics.item_finished(time.monotonic() - started, e)
+            delay = _retry_delay(retry_policy, e, attempt)
+            action = "skipping this item" if delay is None else f"retrying in {delay:.1f}s"
             sys.stderr.write(
-                f"robust_task: processing {name} raised {e.__class__.__name__}: {e}, skipping this item\n"
+                f"robust_task: processing {name} raised {e.__class__.__name__}: {e}, {action}\n"
             )
             sys.stderr.flush()
-            continue
-        if show_progress:
-            pct = int(i / n_objs * 100)
-            sys.stderr.write(f"{i}/{n_objs} - {pct}%\r")
-        progress[name] = results
-    return progress
+            ledger.record(name, value, e)
+            if delay is not None:
+                heapq.heappush(retries, (time.monotonic() + delay, next(seq), name, value, attempt + 1))
+            elif worker:
+                worker.release(name)
+            return
+        if metrics:
+            metrics.item_finished(time.monotonic() - started)
+        ledger.resolve(name)
+        if worker:
+            worker.saved(name, progress)
+
+    def run_due():
+        while retries and retries[0][0] <= time.monotonic():
+            _, _, name, value, attempt = heapq.heappop(retries)
+            run(name, value, attempt)
+
+    try:
+        for i, (name, value) in enumerate(_todo(objs, progress, skip_existing, worker)):
+            if _should_stop(stop):
+                stopped = True
+                if worker:
+                    worker.release(name)
+                break
+            _flush_if_due(progress, worker)
+            run(name, value, 1)
+            run_due()
+            if show_progress:
+                sys.stderr.write(_progress_msg(i, n_objs) + "\r")
+        while retries and not stopped:
+            if _should_stop(stop):
+                break
+            # Nothing finishes while waiting for the next retry
+            _flush(progress, worker)
+            time.sleep(max(0, retries[0][0] - time.monotonic()))
+            run_due()
+    finally:
+        # Write out anything still buffered, even on KeyboardInterrupt
+        _flush(progress, worker)
+        _end_metrics(metrics)
+    return _results(progress, return_results)
+
+
+def _pool_call(task, name, value):
+    # Runs in the worker process, errors are sent back instead of raised
+    # so that one bad item doesn't take down the rest of its chunk
+    started = time.monotonic()
+    try:
+        return name, task(value), None, time.monotonic() - started
+    except Exception as e:
+        return name, None, e, time.monotonic() - started
+
+
+def _pool_chunk(task, chunk):
+    return [_pool_call(task, name, value) for name, value in chunk]
+
+
+"""
+Process pool version of robust_task for CPU-bound tasks
+task must be picklable (ie, defined at the top level of a module)
+workers: number of worker processes (default: number of cpus)
+chunksize: number of items sent to a worker at a time
+Only the parent process writes to the progress file (and the failure ledger),
+saving each chunk's results as soon as it finishes
+"""
+
+
+def pool_robust_task(
+    objs: dict[str, str] | list[str] | Iterable,
+    task,
+    progress_name=DEFAULT_FILENAME,
+    skip_existing=True,
+    show_progress=True,
+    workers=None,
+    chunksize=1,
+    progress_store=None,
+    total=None,
+    return_results=True,
+    worker=None,
+    metrics=None,
+):
+    progress = _open(progress_name, progress_store, worker)
+    ledger = _ledger(progress_name, worker)
+    n_objs = _count(objs, total)
+    _begin_metrics(metrics, progress, n_objs)
+    workers = workers or os.cpu_count()
+    # Wake up every flush_ms to write out buffered results even while
+    # every worker is busy
+    flush_ms = getattr(progress, "flush_ms", None)
+    wait_timeout = flush_ms / 1000 if flush_ms else None
+
+    def save(name, value, results, e, latency):
+        if e is None:
+            try:
+                progress.put(name, results)
+            except Exception as put_error:
+                # eg a result that isn't a JSON serializable dict
+                e = put_error
+        if metrics:
+            # Latency is measured in the worker process
+            metrics.item_finished(latency, e)
+        if e is not None:
+            print_err(f"robust_task: processing {name} raised {e.__class__.__name__}: {e}, skipping this item")
+            ledger.record(name, value, e)
+            if worker:
+                worker.release(name)
+            return
+        ledger.resolve(name)
+        if worker:
+            worker.saved(name, progress)
+
+    i = 0
+    try:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            # Keep a few rounds of chunks in flight so workers don't wait on
+            # us, without materializing a future for every input up front
+            chunks = gen_batches(_todo(objs, progress, skip_existing, worker), chunksize)
+            in_flight = {}
+            while True:
+                for chunk in itertools.islice(chunks, workers * 4 - len(in_flight)):
+                    if metrics:
+                        # in_flight counts everything handed to the pool
+                        for _ in chunk:
+                            metrics.item_started()
+                    in_flight[executor.submit(_pool_chunk, task, chunk)] = chunk
+                if not in_flight:
+                    break
+                finished, _ = wait(in_flight, timeout=wait_timeout, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    chunk = in_flight.pop(future)
+                    try:
+                        outcomes = future.result()
+                    except BrokenProcessPool:
+                        raise
+                    except Exception as e:
+                        # eg a result that can't be pickled back to us
+                        outcomes = [(name, None, e, 0) for name, _ in chunk]
+                    for (name, value), (_, results, e, latency) in zip(chunk, outcomes):
+                        i += 1
+                        save(name, value, results, e, latency)
+                        if show_progress:
+                            sys.stderr.write(_progress_msg(i, n_objs) + "\r")
+                _flush_if_due(progress, worker)
+    finally:
+        _flush(progress, worker)
+        _end_metrics(metrics)
+    return _results(progress, return_results)
+
+
+def _item_error(results, e):
+    # An async task returning None counts as a failure too
+    if e is None and results is None:
+        return ValueError("task returned None")
+    return e
+
+
+async def _process(task, name, value, timeout, metrics=None):
+    if metrics:
+        metrics.item_started()
+        started = time.monotonic()
+    result = await _attempt(task, name, value, timeout)
+    if metrics:
+        metrics.item_finished(time.monotonic() - started, _item_error(result[1], result[2]))
+    return result
+
+
+async def _attempt(task, name, value, timeout):
+    try:
+        results = await asyncio.wait_for(task(value), timeout=timeout)
+        return name, results, None
+    except asyncio.TimeoutError as e:
+        # Don't print an error message
+        print_err(f"robust_task: processing {name} timed out")
+        return name, None, e
+    except Exception as e:
+        print_err(
+            f"robust_task: processing {name} raised {e.__class__.__name__}: {e}, skipping this item"
+        )
+        return name, None, e
 
 
 """
@@ -99,11 +413,21 @@ Each task has a timeout window of 8 seconds.
 Automatically retries to process all timed out items 
     at the end with a doubled timeout window
     (control with retry_timeouts=False
+With sliding_window=True, runs up to batch_size items at a time in a single
+    event loop and starts the next item as soon as any one finishes,
+    instead of waiting for the whole batch.
+    Each of the batch_size slots sleeps for (delay) seconds between items.
+rate_limiter: a rate_limit.AdaptiveLimiter that grows and shrinks the number
+    of items in flight (up to its max_concurrency, instead of batch_size)
+    based on timeouts and rate limit errors. Implies sliding_window=True
+retry_policy: retry failed items with backoff during the run (see robust_task)
+    instead of the doubled-timeout pass at the end. Implies sliding_window=True
+objs, total, return_results, worker, metrics and stop work the same as in robust_task
 """
 
 
 def async_robust_task(
-    objs: dict[str, str] | list[str],
+    objs: dict[str, str] | list[str] | Iterable,
     task,
     progress_name=DEFAULT_FILENAME,
     skip_existing=True,
@@ -112,63 +436,136 @@ def async_robust_task(
     delay=0,
     timeout=8,
     retry_errs=True,
+    progress_store=None,
+    sliding_window=False,
+    rate_limiter=None,
+    total=None,
+    return_results=True,
+    worker=None,
+    retry_policy=None,
+    metrics=None,
+    stop=None,
 ):
-    progress = load_progress(progress_name)
-    if isinstance(objs, list):
-        objs = {k: k for k in objs}
-    n_objs = len(objs.keys())
+    progress = _open(progress_name, progress_store, worker)
+    ledger = _ledger(progress_name, worker)
+    n_objs = _count(objs, total)
     processed = len(progress)
+    _begin_metrics(metrics, progress, n_objs)
 
     bi = 0
     errs = {}
+    # heap of (due time, seq, name, value, attempt, last error) waiting to be retried
+    retries = []
+    seq = itertools.count()
+    in_flight = 0
+    stopped = False
 
-    names = (
-        (k for k in objs.keys() if k not in progress) if skip_existing else objs.keys()
-    )
+    todo = _todo(objs, progress, skip_existing, worker)
 
-    for batch in gen_batches(names, batch_size):
-        bi += 1
+    def save(name, value, e, input, attempt=1):
+        if value is not None:
+            progress.put(name, value)
+            ledger.resolve(name)
+            if worker:
+                worker.saved(name, progress)
+            return
+        ledger.record(name, input, _item_error(value, e))
+        delay = _retry_delay(retry_policy, e, attempt) if e is not None else None
+        if delay is not None:
+            heapq.heappush(retries, (time.monotonic() + delay, next(seq), name, input, attempt + 1, e))
+            return
+        errs[name] = input
+        if worker:
+            worker.release(name)
 
-        async def process(name):
-            try:
-                value = objs[name]
-                results = await asyncio.wait_for(task(value), timeout=timeout)
-                return name, results
-            except asyncio.TimeoutError as e:
-                # Don't print an error message
-                print_err(f"robust_task: processing {name} timed out")
-                return name, None
-            except Exception as e:
-                print_err(
-                    f"robust_task: processing {name} raised {e.__class__.__name__}: {e}, skipping this item"
-                )
-                return name, None
-
-        tasks = []
-        for name in batch:
-            tasks.append(process(name))
-
-        async def execute_all(tasks):
-            results = await asyncio.gather(*tasks)
-            for result in results:
-                name, value = result
-                if value is not None:
-                    save_progress(progress_name, name, value)
-                    progress[name] = value
-                else:
-                    errs[name] = objs[name]
-
-        asyncio.run(execute_all(tasks))
-        processed += len(tasks)
-        if show_progress:
-            pct = int(processed / n_objs * 100)
-            sys.stderr.write(f"{bi}: {processed}/{n_objs} - {pct}%\r")
-        if delay and len(tasks) > 0:
-            time.sleep(delay)
+    def attempt_timeout(e, attempt):
+        policy = policy_for(retry_policy, e) if e is not None else None
+        return timeout * (policy.timeout_multiplier ** (attempt - 1) if policy else 1)
+
+    async def next_item(todo):
+        # Retries that are due come first, then new items. Once the inputs
+        # run out, wait around while other slots might still schedule retries
+        nonlocal stopped
+        while True:
+            if stopped or _should_stop(stop):
+                stopped = True
+                # Leave queued retries in the ledger for retry_failed
+                while worker and retries:
+                    worker.release(heapq.heappop(retries)[2])
+                return None
+            if retries and retries[0][0] <= time.monotonic():
+                return heapq.heappop(retries)[2:]
+            item = next(todo, None)
+            if item is not None:
+                return item[0], item[1], 1, None
+            if not retries and in_flight == 0:
+                return None
+            wait = retries[0][0] - time.monotonic() if retries else 0.05
+            await asyncio.sleep(min(max(wait, 0), 0.05))
+
+    try:
+        if sliding_window or rate_limiter or retry_policy:
+
+            async def slot(todo):
+                nonlocal processed, in_flight
+                # All slots pull from the same iterator, so each slot picks up
+                # the next item as soon as it is free
+                while (item := await next_item(todo)) is not None:
+                    name, value, attempt, last_error = item
+                    in_flight += 1
+                    if rate_limiter:
+                        started = await rate_limiter.acquire()
+                    item_timeout = attempt_timeout(last_error, attempt)
+                    result = await _process(task, name, value, item_timeout, metrics)
+                    if rate_limiter:
+                        rate_limiter.release(started, result[2])
+                    save(*result, value, attempt)
+                    in_flight -= 1
+                    if attempt == 1:
+                        processed += 1
+                    if show_progress:
+                        limit = f" (limit {rate_limiter.concurrency})" if rate_limiter else ""
+                        sys.stderr.write(_progress_msg(processed, n_objs) + f"{limit}\r")
+                    if delay:
+                        await asyncio.sleep(delay)
+
+            async def execute_window(todo):
+                n_slots = rate_limiter.max_concurrency if rate_limiter else batch_size
+                await asyncio.gather(*(slot(todo) for _ in range(n_slots)))
+
+            asyncio.run(_with_flusher(progress, worker, execute_window(iter(todo))))
+        else:
+            for batch in gen_batches(todo, batch_size):
+                if _should_stop(stop):
+                    stopped = True
+                    if worker:
+                        for name, _ in batch:
+                            worker.release(name)
+                    break
+                bi += 1
+
+                tasks = []
+                for name, value in batch:
+                    tasks.append(_process(task, name, value, timeout, metrics))
+
+                async def execute_all(tasks):
+                    results = await asyncio.gather(*tasks)
+                    for result, (_, value) in zip(results, batch):
+                        save(*result, value)
+
+                asyncio.run(_with_flusher(progress, worker, execute_all(tasks)))
+                processed += len(tasks)
+                if show_progress:
+                    sys.stderr.write(f"{bi}: " + _progress_msg(processed, n_objs) + "\r")
+                if delay and len(tasks) > 0:
+                    time.sleep(delay)
+    finally:
+        _flush(progress, worker)
+        _end_metrics(metrics)
 
     if len(errs) > 0:
         print_err(f"{len(errs)} items failed")
-        if retry_errs:
+        if retry_errs and retry_policy is None and not stopped:
             print_err(f"Auto-retrying with doubled timeout ({timeout*2}s)")
             async_robust_task(
                 errs,
@@ -180,17 +577,44 @@ def async_robust_task(
                 delay,
                 timeout * 2,
                 retry_errs=False,
+                progress_store=progress,
+                sliding_window=sliding_window,
+                rate_limiter=rate_limiter,
+                # Results are read from progress below
+                return_results=False,
+                worker=worker,
+                metrics=metrics,
+                stop=stop,
             )
-            progress = load_progress(progress_name)
 
-    return progress
+    return _results(progress, return_results)
+
+
+"""
+Re-run only the items still recorded as failed in the failure ledger of
+    progress_name, without going back over all the inputs
+runner: robust_task (default), async_robust_task or pool_robust_task
+Other keyword arguments are passed on to the runner
+"""
+
+
+def retry_failed(task, progress_name=DEFAULT_FILENAME, runner=robust_task, worker=None, **kwargs):
+    ledger = _ledger(progress_name, worker)
+    pending = ledger.pending()
+    if len(pending) < len(ledger):
+        print_err(f"{len(ledger) - len(pending)} failed items have no saved input, skipping them")
+    return runner(pending, task, progress_name, worker=worker, **kwargs)
 
 
+# For large result sets see export.progress_to_arrow
 def naive_dict_to_tsv(data):
     if len(data) > 0:
         outs = io.StringIO()
-        column_headers = list(data.values())[0].keys()
-        writer = csv.DictWriter(outs, delimiter="\t", fieldnames=column_headers)
+        # Union of the columns of every record, in the order they first appear
+        column_headers = {}
+        for record in data.values():
+            column_headers.update(dict.fromkeys(record.keys()))
+        writer = csv.DictWriter(outs, delimiter="\t", fieldnames=list(column_headers))
         writer.writeheader()
         writer.writerows(data.values())
         return outs.getvalue()
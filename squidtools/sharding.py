@@ -0,0 +1,253 @@
+import os
+import glob
+import json
+import time
+import zlib
+import socket
+import hashlib
+from collections.abc import Mapping
+
+from .progress_store import open_progress, INDEX_SUFFIX
+
+"""
+Run one robust_task job with several workers, on one machine or on several
+machines sharing a filesystem.
+
+Each worker writes its results to its own progress file next to the main one
+(progress.json -> progress.worker-<id>.json), and treats everything in the
+main file and the other workers' files as done. Work is split between the
+workers in one of two ways:
+
+- shard=(index, count): each worker only takes the keys that hash into its
+  shard. No coordination needed, but a dead worker's shard stays undone
+  until it is restarted.
+- lease_timeout=seconds: workers claim each key with a lease file before
+  processing it. Leases from a worker that stopped updating them for
+  lease_timeout seconds are taken over, so lease_timeout should be longer
+  than the slowest item. Finished keys keep a "done" lease, written once
+  their result has been flushed to disk; delete the progress.json.leases
+  directory to redo them.
+
+    worker = Worker("host1-0", lease_timeout=600)
+    robust_task(objs, task, "progress.json", worker=worker)
+
+Once every worker has finished, merge_progress("progress.json") folds the
+worker files back into the main progress file.
+"""
+
+
+def shard_of(key, n_shards):
+    # Stable across processes and machines, unlike hash()
+    return zlib.crc32(json.dumps(key).encode()) % n_shards
+
+
+def worker_progress_name(pname, worker_id):
+    root, ext = os.path.splitext(pname)
+    return f"{root}.worker-{worker_id}{ext}"
+
+
+def worker_progress_names(pname):
+    root, ext = os.path.splitext(pname)
+    return sorted(glob.glob(f"{glob.escape(root)}.worker-*{ext}"))
+
+
+class SharedProgress(Mapping):
+    """
+    Progress store for one worker: writes go to the worker's own file, reads
+    see the main progress file and every worker's file.
+    """
+
+    def __init__(self, pname, worker_id, **kwargs):
+        self.pname = pname
+        self.own = open_progress(worker_progress_name(pname, worker_id), **kwargs)
+        self.others = [
+            open_progress(name, readonly=True)
+            for name in [pname] + worker_progress_names(pname)
+            if name != self.own.pname and os.path.exists(name)
+        ]
+
+    def _stores(self):
+        return self.others + [self.own]
+
+    def __contains__(self, key):
+        return any(key in store for store in self._stores())
+
+    def __getitem__(self, key):
+        # Own results are the most recent
+        for store in reversed(self._stores()):
+            if key in store:
+                return store[key]
+        raise KeyError(key)
+
+    def __iter__(self):
+        seen = set()
+        for store in self._stores():
+            for key in store:
+                if key not in seen:
+                    seen.add(key)
+                    yield key
+
+    def __len__(self):
+        return len(set().union(*self._stores()))
+
+    def put(self, key, result: dict):
+        self.own.put(key, result)
+
+    @property
+    def unflushed(self):
+        return getattr(self.own, "unflushed", 0)
+
+    @property
+    def flush_ms(self):
+        return getattr(self.own, "flush_ms", None)
+
+    def flush_if_due(self):
+        return self.own.flush_if_due()
+
+    def flush(self):
+        self.own.flush()
+
+    def refresh(self):
+        for store in self.others:
+            store.refresh()
+
+    def records(self):
+        for store in self._stores():
+            yield from store.records()
+
+    def to_dict(self):
+        return dict(self.records())
+
+    def compact(self):
+        return self.own.compact()
+
+    def close(self):
+        for store in self._stores():
+            store.close()
+
+
+class Worker:
+    """
+    worker_id: unique name for this worker, defaults to hostname-pid
+    shard: (index, count), only take keys that hash into shard index
+    lease_timeout: claim keys with lease files, taking over leases that
+        haven't been touched in this many seconds
+    lease_dir: where the lease files go, defaults to progress_name + ".leases"
+    """
+
+    def __init__(self, worker_id=None, shard=None, lease_timeout=None, lease_dir=None):
+        self.worker_id = worker_id or f"{socket.gethostname()}-{os.getpid()}"
+        self.shard = shard
+        self.lease_timeout = lease_timeout
+        self.lease_dir = lease_dir
+        self._default_lease_dir = lease_dir is None
+        # saved keys whose results haven't been flushed yet
+        self._unflushed = []
+
+    def use_progress_name(self, pname):
+        """Keep leases next to pname, unless lease_dir was given"""
+        if self._default_lease_dir:
+            self.lease_dir = pname + ".leases"
+
+    def open_progress(self, pname, **kwargs):
+        self.use_progress_name(pname)
+        return SharedProgress(pname, self.worker_id, **kwargs)
+
+    def owns(self, key):
+        if self.shard is None:
+            return True
+        index, count = self.shard
+        return shard_of(key, count) == index
+
+    def _lease_path(self, key):
+        h = hashlib.sha1(json.dumps(key).encode()).hexdigest()
+        # Spread lease files over subdirectories to keep directories small
+        return os.path.join(self.lease_dir, h[:2], h)
+
+    def _write_lease(self, path, state):
+        tmp = f"{path}.{self.worker_id}.tmp"
+        with open(tmp, "wt") as f:
+            json.dump({"worker": self.worker_id, "state": state, "time": time.time()}, f)
+        os.replace(tmp, path)
+
+    def claim(self, key):
+        """Try to take key, returns False if it is done or held by a live worker"""
+        if not self.owns(key):
+            return False
+        if self.lease_timeout is None:
+            return True
+        path = self._lease_path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        try:
+            fd = os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            os.close(fd)
+            self._write_lease(path, "held")
+            return True
+        except FileExistsError:
+            pass
+        try:
+            age = time.time() - os.path.getmtime(path)
+            with open(path, "rt") as f:
+                lease = json.load(f)
+        except FileNotFoundError:
+            # Released by another worker in the meantime, race for it again
+            return self.claim(key)
+        except ValueError:
+            # Still being written, or its worker died before writing it
+            lease = {"worker": None, "state": "held"}
+        if lease["state"] == "done":
+            return False
+        if lease["worker"] == self.worker_id or age > self.lease_timeout:
+            # Two workers can both take over the same stale lease, in which
+            # case the item is just processed twice and the later result wins
+            self._write_lease(path, "held")
+            return True
+        return False
+
+    def done(self, key):
+        if self.lease_timeout is not None:
+            self._write_lease(self._lease_path(key), "done")
+
+    def saved(self, key, progress):
+        """
+        key's result was put in progress: mark it done now if progress has
+        written it out, otherwise on the next flushed()
+        """
+        self._unflushed.append(key)
+        if not getattr(progress, "unflushed", 0):
+            self.flushed()
+
+    def flushed(self):
+        """The progress store was flushed, everything saved so far is done"""
+        keys, self._unflushed = self._unflushed, []
+        for key in keys:
+            self.done(key)
+
+    def release(self, key):
+        """Give up a claimed key (eg after it failed) so any worker can retry it"""
+        if self.lease_timeout is not None:
+            try:
+                os.remove(self._lease_path(key))
+            except FileNotFoundError:
+                pass
+
+
+def merge_progress(pname, remove=True):
+    """
+    Copy every worker's results into the main progress file.
+    Only run this once all workers have stopped.
+    """
+    main = open_progress(pname, flush_every=10000)
+    names = worker_progress_names(pname)
+    for name in names:
+        worker = open_progress(name, readonly=True)
+        for key, record in worker.records():
+            main.put(key, record)
+        worker.close()
+    main.close()
+    if remove:
+        for name in names:
+            os.remove(name)
+            if os.path.exists(name + INDEX_SUFFIX):
+                os.remove(name + INDEX_SUFFIX)
+    return len(names)
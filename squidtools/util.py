@@ -1,5 +1,7 @@
 import csv
 import sys
+import functools
+import threading
 
 def write_csv(records, filename, delimiter):
     fieldnames = set()
@@ -27,4 +29,19 @@ def gen_batches(iterable, max_batch_size: int):
             yield batch
             batch = []
     if len(batch) > 0:
-        yield batch
\ No newline at end of file
+        yield batch
+
+def lazy(load):
+    """ Runs load() on the first call only, even with several threads calling at once, and returns its result every time. """
+    lock = threading.Lock()
+    loaded = []
+
+    @functools.wraps(load)
+    def get():
+        if not loaded:
+            with lock:
+                if not loaded:
+                    loaded.append(load())
+        return loaded[0]
+
+    return get
\ No newline at end of file